@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+
+Memory benchmark: bytes held per tracked job and per subscription once a
+project of chats_projects.json is loaded, as nested dicts like before the
+compact records and as records.
+
+    python -m benchmarks.memory --jobs 100000 --chats 2
+"""
+
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Mapping, Tuple
+
+from classes.table import KINDS, Table
+
+STATUSES = ("success", "failed", "running", "pending", "canceled")
+
+
+def write_table(path: str, jobs: int, chats: int) -> None:
+    """
+    Write a project with chats subscribed and jobs displayed in every chat
+    """
+    project = {str(-1000000000000 - chat): {"verbosity": 3} for chat in range(chats)}
+    project["jobs"] = {
+        str(1000000 + job): {
+            "status": STATUSES[job % len(STATUSES)],
+            "messages": {
+                str(-1000000000000 - chat): [100000 + job] for chat in range(chats)
+            },
+            "bots": {str(-1000000000000 - chat): 123456789 for chat in range(chats)},
+            "hashes": {
+                str(-1000000000000 - chat): f"{job:016x}" for chat in range(chats)
+            },
+        }
+        for job in range(jobs)
+    }
+    with open(path, "w") as table_file:
+        json.dump({"token": project}, table_file)
+
+
+def write_subscriptions(path: str, projects: int, chats: int) -> None:
+    """
+    Write projects without tracked objects, each with chats subscribed
+    """
+    table = {
+        f"token-{project}": {
+            str(-1000000000000 - chat): {"verbosity": 3} for chat in range(chats)
+        }
+        for project in range(projects)
+    }
+    with open(path, "w") as table_file:
+        json.dump(table, table_file)
+
+
+def load_dicts(path: str, tokens: List[str]) -> dict:
+    """
+    Load projects as nested dicts, the representation used before the
+    compact records
+    """
+    with open(path) as table_file:
+        raw = json.load(table_file)
+    projects = {}
+    for token in tokens:
+        project = {}
+        for key, value in raw.pop(token).items():
+            if key in KINDS:
+                project[key] = {int(id): record for id, record in value.items()}
+            else:
+                project[int(key)] = value
+        projects[token] = project
+    return projects
+
+
+def load_records(path: str, tokens: List[str]) -> Table:
+    """
+    Load projects with Table, as compact records
+    """
+    table = Table(path)
+    for token in tokens:
+        table[token]
+    return table
+
+
+def measure(
+    load: Callable[[str, List[str]], Mapping], path: str, tokens: List[str]
+) -> Tuple[int, Mapping]:
+    """
+    Return the bytes still allocated once the projects are loaded, and the table
+    """
+    gc.collect()
+    tracemalloc.start()
+    table = load(path, tokens)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, table
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument("--jobs", type=int, default=100000)
+    parser.add_argument("--chats", type=int, default=1)
+    args = parser.parse_args()
+    if args.jobs < 1 or args.chats < 1:
+        parser.error("--jobs and --chats must be positive")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "chats_projects.json")
+        write_table(path, args.jobs, args.chats)
+        print(f"chats_projects.json: {os.path.getsize(path) / 1e6:.1f} MB")
+        projects = max(1, args.jobs // 100)
+        tokens = [f"token-{project}" for project in range(projects)]
+        print(f"{'':24}{'dicts':>10}{'records':>10}")
+
+        results = {}
+        for name, load in (("dicts", load_dicts), ("records", load_records)):
+            write_table(path, args.jobs, args.chats)
+            jobs, table = measure(load, path, ["token"])
+            tracked = table["token"]["jobs"]
+            start = time.perf_counter()
+            for job in range(1000000, 1000000 + args.jobs):
+                tracked[job].get("status") if name == "dicts" else tracked[job].status
+            lookup = (time.perf_counter() - start) / args.jobs
+            del table, tracked
+            write_subscriptions(path, projects, 100)
+            subscriptions, table = measure(load, path, tokens)
+            del table
+            results[name] = (
+                jobs / args.jobs,
+                lookup * 1e9,
+                subscriptions / (projects * 100),
+            )
+
+        for i, label in enumerate(
+            (
+                "bytes per tracked job",
+                "tracked job lookup (ns)",
+                "bytes per subscription",
+            )
+        ):
+            print(f"{label:24}{results['dicts'][i]:10.1f}{results['records'][i]:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
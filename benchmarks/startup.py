@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+
+Startup benchmark: time spent before the server can listen, and before the
+first event of a project can be handled, with a large chats_projects.json.
+
+    python -m benchmarks.startup --projects 200 --jobs 5000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from classes.context import Context
+
+
+def write_state(directory: str, projects: int, jobs: int) -> None:
+    """
+    Write a config and a table with jobs and pipelines for every project
+    """
+    config = {
+        "port": 8080,
+        "telegram-token": "",
+        "passphrase": None,
+        "gitlab-projects": [
+            {"name": f"project {i}", "token": f"token-{i}", "user-ids": []}
+            for i in range(projects)
+        ],
+        "log-level": "WARNING",
+    }
+    table = {}
+    for i in range(projects):
+        project = {str(-1000000 - chat): {"verbosity": 3} for chat in range(10)}
+        project["jobs"] = {
+            str(job): {"status": "success", "messages": {"-1000000": [job]}}
+            for job in range(jobs)
+        }
+        project["pipelines"] = {
+            str(pipeline): {"status": "failed", "messages": {"-1000000": [pipeline]}}
+            for pipeline in range(jobs // 10)
+        }
+        project["merge_requests"] = {}
+        table[f"token-{i}"] = project
+    with open(os.path.join(directory, "config.json"), "w") as config_file:
+        json.dump(config, config_file)
+    with open(os.path.join(directory, "verified_chats.json"), "w") as chats_file:
+        json.dump([], chats_file)
+    with open(os.path.join(directory, "chats_projects.json"), "w") as table_file:
+        json.dump(table, table_file)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--projects", type=int, default=200)
+    parser.add_argument("--jobs", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory += "/"
+        write_state(directory, args.projects, args.jobs)
+        size = os.path.getsize(directory + "chats_projects.json")
+        print(f"chats_projects.json: {size / 1e6:.1f} MB")
+
+        start = time.perf_counter()
+        context = Context(directory)
+        context.get_config()
+        ready = time.perf_counter()
+        context.table["token-0"]["jobs"]
+        first = time.perf_counter()
+        for token in context.table:
+            context.table[token]
+        full = time.perf_counter()
+
+        print(f"config loaded, server can listen : {(ready - start) * 1000:8.1f} ms")
+        print(f"first project available          : {(first - start) * 1000:8.1f} ms")
+        print(f"every project rebuilt            : {(full - start) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
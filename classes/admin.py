@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import hmac
+from typing import Tuple
+from urllib.parse import parse_qs, urlparse
+
+from classes.context import DEFAULT_VERBOSITY, Context
+from classes.digest import EVENTS, MODES
+from classes.table import KINDS
+
+VERBOSITY_LEVELS = range(4)
+
+
+def is_verbosity(value) -> bool:
+    """
+    Test if a JSON value is a verbosity level, true and false are not
+    """
+    return type(value) is int and value in VERBOSITY_LEVELS
+
+
+def is_admin(context: Context, headers) -> bool:
+    """
+    Test the admin token of a request, the API is disabled without admin-token
+    """
+    expected = context.config.get("admin-token")
+    given = headers["X-Admin-Token"]
+    if not expected or not given:
+        return False
+    return hmac.compare_digest(expected.encode("utf-8"), given.encode("utf-8"))
+
+
+def _apply(context: Context, operation: dict) -> dict:
+    """
+    Apply one subscription change
+    """
+    op = operation.get("op")
+    project = context.get_project(str(operation.get("project")))
+    if project is None:
+        return {"ok": False, "error": "unknown project"}
+    try:
+        chat_id = int(operation.get("chat"))
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "invalid chat"}
+    token = project["token"]
+    if op == "subscribe":
+        verbosity = operation.get("verbosity", DEFAULT_VERBOSITY)
+        if not is_verbosity(verbosity):
+            return {"ok": False, "error": "invalid verbosity"}
+        changed = context.subscribe(chat_id, token, verbosity)
+    elif op == "unsubscribe":
+        changed = context.unsubscribe(chat_id, token)
+    elif op == "verbosity":
+        if not is_verbosity(operation.get("verbosity")):
+            return {"ok": False, "error": "invalid verbosity"}
+        if not context.is_subscribed(chat_id, token):
+            return {"ok": False, "error": "not subscribed"}
+        changed = context.set_verbosity(chat_id, token, operation["verbosity"])
+    elif op == "issue-replies":
+        if not isinstance(operation.get("enabled"), bool):
+            return {"ok": False, "error": "enabled must be a boolean"}
+        if not context.is_subscribed(chat_id, token):
+            return {"ok": False, "error": "not subscribed"}
+        changed = context.set_issue_replies(chat_id, token, operation["enabled"])
+    elif op == "resume":
+        if not context.is_subscribed(chat_id, token):
+            return {"ok": False, "error": "not subscribed"}
+        changed = context.resume(chat_id)
+    elif op == "digest":
+        if operation.get("event") not in EVENTS:
+            return {"ok": False, "error": "event must be one of " + ", ".join(EVENTS)}
+        if operation.get("mode") not in MODES:
+            return {"ok": False, "error": "mode must be one of " + ", ".join(MODES)}
+        if not context.is_subscribed(chat_id, token):
+            return {"ok": False, "error": "not subscribed"}
+        changed = context.set_digest(
+            chat_id, token, operation["event"], operation["mode"]
+        )
+    else:
+        return {"ok": False, "error": "unknown op"}
+    return {"ok": True, "changed": changed}
+
+
+def _dead_letter(context: Context, entry: dict) -> dict:
+    """
+    Return a dead letter without the secret token of its project
+    """
+    operation = dict(entry["operation"])
+    if "track" in operation:
+        track = dict(operation["track"])
+        project = context.projects.get(track.pop("token"))
+        track["project"] = project["name"] if project else None
+        operation["track"] = track
+    return {**entry, "operation": operation}
+
+
+def post(context: Context, path: str, body: dict) -> Tuple[int, dict]:
+    """
+    Handle an admin POST request, return the HTTP code and the JSON payload
+    """
+    if path == "/admin/dead-letters/replay":
+        if context.retries is None:
+            return 503, {"error": "the bot is not started yet"}
+        return 200, {"replayed": context.retries.replay()}
+    if path != "/admin/subscriptions":
+        return 404, {"error": "not found"}
+    operations = body.get("operations") if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        return 400, {"error": "operations must be a list"}
+    with context.batch():
+        results = [
+            _apply(context, operation)
+            if isinstance(operation, dict)
+            else {"ok": False, "error": "invalid operation"}
+            for operation in operations
+        ]
+    return 200, {"results": results}
+
+
+def get(context: Context, url: str) -> Tuple[int, dict]:
+    """
+    Handle an admin GET request, return the HTTP code and the JSON payload
+    """
+    parsed = urlparse(url)
+    query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+    if parsed.path == "/admin/chats":
+        project = context.get_project(query.get("project", ""))
+        if project is None:
+            return 404, {"error": "unknown project"}
+        token = project["token"]
+        chats = [
+            {
+                "chat": chat_id,
+                "verbosity": context.table[token][chat_id].verbosity,
+                "suspended": context.table[token][chat_id].suspended,
+            }
+            for chat_id in context.chats_of(token)
+        ]
+        return 200, {"project": project["name"], "chats": chats}
+    if parsed.path == "/admin/projects":
+        try:
+            chat_id = int(query.get("chat"))
+        except (TypeError, ValueError):
+            return 400, {"error": "invalid chat"}
+        projects = [
+            {
+                "project": project["name"],
+                "verbosity": context.table[project["token"]][chat_id].verbosity,
+                "suspended": context.table[project["token"]][chat_id].suspended,
+            }
+            for project in context.projects_of(chat_id)
+        ]
+        return 200, {"chat": chat_id, "projects": projects}
+    if parsed.path == "/admin/health":
+        suspended = [
+            {"chat": chat_id, "project": project["name"], **subscription.suspended}
+            for project in context.projects.values()
+            if project["token"] in context.table
+            for chat_id, subscription in context.table[project["token"]].items()
+            if chat_id not in KINDS and subscription.suspended
+        ]
+        breaker = context.breaker
+        return 200, {
+            "telegram": "unreachable" if breaker and breaker.is_open else "ok",
+            "suspended": suspended,
+        }
+    if parsed.path == "/admin/dead-letters":
+        if context.retries is None:
+            return 503, {"error": "the bot is not started yet"}
+        entries = context.retries.dead_letters()
+        return 200, {
+            "pending_retries": context.retries.pending(),
+            "dead_letters": [_dead_letter(context, entry) for entry in entries],
+        }
+    return 404, {"error": "not found"}
@@ -8,15 +8,24 @@ import json
 import logging
 import os
 import socketserver
-import sys
+import threading
 from http.server import BaseHTTPRequestHandler
-from typing import TypeVar
+from typing import Callable, TypeVar
 
 from telegram.ext import CallbackContext
 
 import handlers
-from classes.bot import Bot
+from classes import admin
+from classes.capture import TrafficCapture
+from classes.coalescer import Coalescer
 from classes.context import Context
+from classes.dedup import DedupCache, delivery_key
+from classes.digest import Digests
+from classes.health import ChatHealth, CircuitBreaker
+from classes.pool import BotPool
+from classes.ratelimit import RateLimiter
+from classes.retry import RetryScheduler
+from classes.worker import HIGH, LOW, NORMAL, Event, Worker
 
 PUSH = "Push Hook"
 TAG = "Tag Push Hook"
@@ -44,6 +53,47 @@ HANDLERS = {
     PIPELINE: handlers.pipeline_handler,
 }
 
+LOW_PRIORITY_EVENTS = (PUSH, JOB)
+HIGH_PRIORITY_EVENTS = (MR,)
+
+
+def event_priority(type: str, body: dict) -> int:
+    """
+    Return the priority of an event, low priority events are shed first
+    """
+    if type == PIPELINE and body.get("object_attributes", {}).get("status") == "failed":
+        return HIGH
+    if type in HIGH_PRIORITY_EVENTS:
+        return HIGH
+    if type in LOW_PRIORITY_EVENTS:
+        return LOW
+    return NORMAL
+
+
+def get_processor(bot: BotPool, context: Context) -> Callable[[Event], None]:
+    """
+    A wrapper for the function handling the queued events
+    """
+
+    def process(event: Event) -> None:
+        token = event.token
+        if token in context.table and context.table[token]:
+            chats = [
+                {
+                    "id": chat,
+                    "verbosity": subscription.verbosity,
+                    "issue_replies": subscription.issue_replies,
+                    "digests": subscription.digests or {},
+                }
+                for chat, subscription in context.table[token].items()
+                if chat in context.verified_chats and not subscription.suspended
+            ]
+            HANDLERS[event.type](event.body, bot, chats, token)
+        else:
+            logging.warning("No chats.")
+
+    return process
+
 
 RequestHandlerType = TypeVar(
     "RequestHandlerType",
@@ -51,7 +101,7 @@ RequestHandlerType = TypeVar(
 )
 
 
-def get_RequestHandler(bot: Bot, context: CallbackContext) -> RequestHandlerType:
+def get_RequestHandler(context: CallbackContext, worker: Worker) -> RequestHandlerType:
     """
     A wrapper for the RequestHandler class to pass parameters
     """
@@ -62,8 +112,8 @@ def get_RequestHandler(bot: Bot, context: CallbackContext) -> RequestHandlerType
         """
 
         def __init__(self, *args, **kwargs) -> None:
-            self.bot = bot
             self.context = context
+            self.worker = worker
             super().__init__(*args, **kwargs)
 
         def _set_headers(self, code: int) -> None:
@@ -74,33 +124,60 @@ def get_RequestHandler(bot: Bot, context: CallbackContext) -> RequestHandlerType
             self.send_header("Content-type", "text/html")
             self.end_headers()
 
+        def _send_json(self, code: int, payload: dict) -> None:
+            """
+            Send response with code and a JSON body
+            """
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            """
+            Handler for GET requests, serves the metrics and the admin API
+            """
+            if self.path == "/metrics":
+                self._send_json(200, self.context.metrics.snapshot())
+            elif self.path.startswith("/admin/"):
+                if not admin.is_admin(self.context, self.headers):
+                    self._set_headers(403)
+                    return
+                self._send_json(*admin.get(self.context, self.path))
+            else:
+                self._set_headers(404)
+
         def do_POST(self) -> None:
             """
             Handler for POST requests
             """
+            if self.path.startswith("/admin/"):
+                self.admin_POST()
+                return
             token = self.headers["X-Gitlab-Token"]
             if self.context.is_authorized_project(token):
                 type = self.headers["X-Gitlab-Event"]
                 content_length = int(self.headers["Content-Length"])
                 data = self.rfile.read(content_length)
-                body = json.loads(data.decode("utf-8"))
+                if self.context.capture:
+                    self.context.capture.record(self.headers, data)
+                key = delivery_key(self.headers, token, data)
+                if self.context.dedup.seen(key):
+                    logging.info(f"Duplicate delivery {key} ignored")
+                    self._set_headers(200)
+                    return
                 if type in HANDLERS:
-                    if token in self.context.table and self.context.table[token]:
-                        chats = [
-                            {
-                                "id": chat,
-                                "verbosity": self.context.table[token][chat][
-                                    "verbosity"
-                                ],
-                            }
-                            for chat in self.context.table[token]
-                            if chat in self.context.verified_chats
-                        ]
-                        HANDLERS[type](body, bot, chats, token)
-                        self._set_headers(200)
-                    else:
-                        logging.warning("No chats.")
+                    if not self.context.rate_limiter.allow(token):
+                        # GitLab disables hooks answering 4xx, accept and drop
+                        logging.warning(f"Rate limit exceeded, dropping {type}")
                         self._set_headers(200)
+                        return
+                    body = json.loads(data.decode("utf-8"))
+                    event = Event(type, body, token, key, event_priority(type, body))
+                    self.worker.submit(event)
+                    self._set_headers(200)
                 else:
                     logging.error("No handler for the event " + type)
                     self._set_headers(404)
@@ -108,6 +185,22 @@ def get_RequestHandler(bot: Bot, context: CallbackContext) -> RequestHandlerType
                 logging.warning("Unauthorized project : token not in config.json")
                 self._set_headers(403)
 
+        def admin_POST(self) -> None:
+            """
+            Handler for POST requests on the admin API
+            """
+            if not admin.is_admin(self.context, self.headers):
+                logging.warning("Unauthorized admin request")
+                self._set_headers(403)
+                return
+            data = self.rfile.read(int(self.headers["Content-Length"] or 0))
+            try:
+                body = json.loads(data.decode("utf-8")) if data else {}
+            except ValueError:
+                self._send_json(400, {"error": "invalid JSON"})
+                return
+            self._send_json(*admin.post(self.context, self.path, body))
+
     return RequestHandler
 
 
@@ -126,23 +219,44 @@ class App:
         """
         context = Context(self.directory)
         context.get_config()
-        context.migrate_table_config()
+        context.autosave(context.config.get("table-save-interval", 30))
+        context.dedup = DedupCache(
+            context.config.get("dedup-size", 10000),
+            context.config.get("dedup-ttl", 3600),
+            context.metrics,
+        )
+        rate_limit = context.config.get("rate-limit", {})
+        context.rate_limiter = RateLimiter(
+            rate_limit.get("rate", 10),
+            rate_limit.get("burst", 100),
+            {
+                project["token"]: project["rate-limit"]
+                for project in context.config["gitlab-projects"]
+                if "rate-limit" in project
+            },
+            context.metrics,
+        )
+        capture = context.config.get("capture", {})
+        if capture.get("sample-rate", 0) > 0:
+            context.capture = TrafficCapture(
+                context.directory + "captures",
+                capture["sample-rate"],
+                capture.get("max-file-size", 10) * 1024 * 1024,
+                capture.get("max-files", 10),
+                context.metrics,
+            )
         logging.info("Starting gitlab-webhook-telegram app")
-        logging.debug("Getting bot with token " + context.config["telegram-token"])
-        try:
-            bot = Bot(context.config["telegram-token"], context)
-            logging.info("Bot " + bot.username + " grabbed. Let's go.")
-        except Exception as e:
-            logging.critical("Failed to grab bot. Stopping here the program.")
-            logging.critical("Exception : " + str(e))
-            sys.exit()
+        worker = Worker(context, context.config.get("load-shedding", {}))
         logging.info(
             "Starting server on http://localhost:" + str(context.config["port"])
         )
         try:
-            RequestHandler = get_RequestHandler(bot, context)
+            RequestHandler = get_RequestHandler(context, worker)
             socketserver.TCPServer.allow_reuse_address = True
             httpd = socketserver.TCPServer(("", context.config["port"]), RequestHandler)
+            threading.Thread(
+                target=self.start_bot, args=(context, worker), name="bot", daemon=True
+            ).start()
             httpd.serve_forever()
         except KeyboardInterrupt:
             logging.info("Keyboard interruption received. Shutting down the server")
@@ -150,3 +264,62 @@ class App:
         httpd.shutdown()
         logging.info("Server is down")
         os._exit(0)
+
+    def start_bot(self, context: Context, worker: Worker) -> None:
+        """
+        Grab the bot once the server listens, then handle the spooled events
+        """
+        tokens = context.config["telegram-token"]
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        logging.debug("Getting bots with tokens " + ", ".join(tokens))
+        try:
+            pool = BotPool(tokens, context)
+            usernames = ", ".join(bot.username for bot in pool.bots)
+            logging.info("Bots " + usernames + " grabbed. Let's go.")
+        except Exception as e:
+            logging.critical("Failed to grab bot. Stopping here the program.")
+            logging.critical("Exception : " + str(e))
+            os._exit(1)
+        health = context.config.get("chat-health", {})
+        if health.get("max-failures", 3) > 0:
+            context.health = ChatHealth(
+                context.suspend_chat,
+                health.get("max-failures", 3),
+                context.metrics,
+            )
+        breaker = context.config.get("circuit-breaker", {})
+        if breaker.get("max-failures", 5) > 0:
+            context.breaker = CircuitBreaker(
+                lambda: [bot.bot.get_me() for bot in pool.bots],
+                breaker.get("max-failures", 5),
+                breaker.get("probe-interval", 10),
+                context.metrics,
+            )
+        retry = context.config.get("retry", {})
+        context.retries = RetryScheduler(
+            lambda operation: handlers.retry(pool, operation),
+            context.directory + "dead_letters.jsonl",
+            retry.get("max-attempts", 5),
+            retry.get("base-delay", 2),
+            retry.get("max-delay", 300),
+            context.metrics,
+        )
+        notes = context.config.get("note-coalescing", {})
+        if notes.get("window", 2) > 0:
+            context.note_coalescer = Coalescer(
+                lambda key, items: handlers.flush_notes(pool, key, items),
+                notes.get("window", 2),
+                notes.get("max-batch", 50),
+                notes.get("max-delay", 10),
+            )
+        digest = context.config.get("digest", {})
+        context.digests = Digests(
+            context.directory + "digests.json",
+            lambda chat_id, mode, buffer: handlers.send_digest(
+                pool, chat_id, mode, buffer
+            ),
+            digest.get("max-items", 100),
+            digest.get("daily-hour", 8),
+        )
+        worker.start(get_processor(pool, context))
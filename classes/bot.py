@@ -5,6 +5,7 @@ gitlab-webhook-telegram
 """
 
 import time
+from typing import List
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
@@ -17,12 +18,15 @@ from telegram.ext import (
 )
 
 from classes.context import Context
+from classes.ratelimit import TokenBucket
+from classes.splitter import split_message
 
-MODE_ADD_PROJECT = 1
-MODE_REMOVE_PROJECT = 2
-MODE_CHANGE_VERBOSITY_1 = 3
-MODE_CHANGE_VERBOSITY_2 = 4
-MODE_NONE = 0
+ACTION_ADD_PROJECT = "add"
+ACTION_REMOVE_PROJECT = "rm"
+ACTION_CHOOSE_VERBOSITY = "vb"
+ACTION_SET_VERBOSITY = "vs"
+
+WAIT_FOR_VERIFICATION = "verification"
 
 V = 0
 VV = 1
@@ -55,81 +59,134 @@ VERBOSITIES = [
 ]
 
 
+def callback_data(action: str, *arguments: str) -> str:
+    """
+    Build the data of an inline button, Telegram limits it to 64 bytes
+    """
+    return ":".join((action,) + arguments)
+
+
 class Bot:
     """
     A wrapper for the telegram bot
     """
 
-    def __init__(self, token: str, context: Context) -> None:
+    def __init__(self, token: str, context: Context, connections: int = None) -> None:
         self.token = token
         self.context = context
-        self.updater = Updater(token=self.token, use_context=True)
+        workers = self.context.config.get("bot-workers", 4)
+        self.updater = Updater(
+            token=self.token,
+            use_context=True,
+            workers=workers,
+            base_url=self.context.config.get("telegram-api-url"),
+            request_kwargs={"con_pool_size": connections or workers + 4},
+        )
         self.bot = self.updater.bot
         self.username = self.bot.username
+        self.id = self.bot.id
         self.dispatcher = self.updater.dispatcher
+        rate_limit = self.context.config.get("telegram-rate-limit", {})
+        self.limiter = TokenBucket(
+            rate_limit.get("rate", 30), rate_limit.get("burst", 30)
+        )
 
-        start_handler = CommandHandler("start", self.start)
+        start_handler = CommandHandler("start", self.start, run_async=True)
         self.dispatcher.add_handler(start_handler)
 
-        add_project_handler = CommandHandler("addProject", self.add_project)
+        add_project_handler = CommandHandler(
+            "addProject", self.add_project, run_async=True
+        )
         self.dispatcher.add_handler(add_project_handler)
 
-        remove_project_handler = CommandHandler("removeProject", self.remove_project)
+        remove_project_handler = CommandHandler(
+            "removeProject", self.remove_project, run_async=True
+        )
         self.dispatcher.add_handler(remove_project_handler)
 
         change_verbosity_handler = CommandHandler(
-            "changeVerbosity", self.change_verbosity
+            "changeVerbosity", self.change_verbosity, run_async=True
         )
         self.dispatcher.add_handler(change_verbosity_handler)
 
-        list_projects_handlers = CommandHandler("listProjects", self.list_projects)
+        list_projects_handlers = CommandHandler(
+            "listProjects", self.list_projects, run_async=True
+        )
         self.dispatcher.add_handler(list_projects_handlers)
 
-        help_hanlder = CommandHandler("help", self.help)
+        help_hanlder = CommandHandler("help", self.help, run_async=True)
         self.dispatcher.add_handler(help_hanlder)
 
-        self.dispatcher.add_handler(CallbackQueryHandler(self.button))
+        self.dispatcher.add_handler(CallbackQueryHandler(self.button, run_async=True))
 
-        message_handler = MessageHandler(Filters.text, self.message)
+        message_handler = MessageHandler(Filters.text, self.message, run_async=True)
         self.dispatcher.add_handler(message_handler)
 
         self.updater.start_polling()
 
     def send_message(
-        self, chat_id: int, message: str, markup: InlineKeyboardMarkup = None
-    ) -> int:
+        self,
+        chat_id: int,
+        message: str,
+        markup: InlineKeyboardMarkup = None,
+        reply_to: int = None,
+        sent: List[int] = None,
+    ) -> List[int]:
         """
-        Send a message to a chat ID, split long text in multiple messages
+        Send a message to a chat ID, split long text in multiple messages.
+        The markup is attached to the last part, all the part ids are returned.
+        The parts whose ids are in sent were delivered by a previous attempt,
+        on failure the ids delivered so far are set on the error as message_ids
         """
-        max_message_length = 4096
-        if len(message) <= max_message_length:
-            message = self.bot.send_message(
-                chat_id=chat_id,
-                text=message,
-                reply_markup=markup,
-                parse_mode="HTML",
-            )
-            return message.message_id
-        parts = []
-        while len(message) > 0:
-            if len(message) > max_message_length:
-                part = message[:max_message_length]
-                first_lnbr = part.rfind("\n")
-                if first_lnbr != -1:
-                    parts.append(part[:first_lnbr])
-                    message = message[first_lnbr:]
-                else:
-                    parts.append(part)
-                    message = message[max_message_length:]
-            else:
-                parts.append(message)
-                break
-        for part in parts:
-            message = self.bot.send_message(
-                chat_id=chat_id, text=part, reply_markup=markup, parse_mode="HTML"
-            )
-            time.sleep(0.25)
-        return message.message_id
+        parts = split_message(message)
+        message_ids = list(sent or [])
+        for i, part in enumerate(parts[len(message_ids) :], len(message_ids)):
+            if i > len(sent or []):
+                time.sleep(0.25)
+            self.limiter.acquire()
+            try:
+                result = self.bot.send_message(
+                    chat_id=chat_id,
+                    text=part,
+                    reply_markup=markup if i == len(parts) - 1 else None,
+                    reply_to_message_id=reply_to if i == 0 else None,
+                    parse_mode="HTML",
+                )
+            except Exception as e:
+                e.message_ids = message_ids
+                raise
+            message_ids.append(result.message_id)
+        return message_ids
+
+    def edit_message_reply_markup(
+        self, chat_id: int, message_id: int, markup: InlineKeyboardMarkup
+    ) -> None:
+        """
+        Replace the inline keyboard of a message
+        """
+        self.limiter.acquire()
+        self.bot.edit_message_reply_markup(
+            chat_id=chat_id, message_id=message_id, reply_markup=markup
+        )
+
+    def edit_message_text(
+        self,
+        chat_id: int,
+        message_id: int,
+        message: str,
+        markup: InlineKeyboardMarkup = None,
+    ) -> None:
+        """
+        Replace the text and the inline keyboard of a message
+        """
+        self.limiter.acquire()
+        self.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=message,
+            reply_markup=markup,
+            parse_mode="HTML",
+        )
 
     def start(self, update: Update, context: CallbackContext) -> None:
         """
@@ -137,6 +194,7 @@ class Bot:
         """
         chat_id = update.message.chat_id
         bot = context.bot
+        self.context.set_chat_bot(chat_id, self.id)
         bot.send_message(
             chat_id=chat_id, text="Hi. I'm a simple bot triggered by GitLab webhooks."
         )
@@ -149,8 +207,7 @@ class Bot:
                 ),
             )
         elif not self.context.config["passphrase"]:
-            self.context.verified_chats.append(chat_id)
-            self.context.write_verified_chats()
+            self.context.verify_chat(chat_id)
             bot.send_message(
                 chat_id=chat_id,
                 text=(
@@ -166,7 +223,7 @@ class Bot:
                     " the passphrase."
                 ),
             )
-            self.context.wait_for_verification = True
+            self.context.conversations.set(chat_id, WAIT_FOR_VERIFICATION)
 
     def add_project(self, update: Update, context: CallbackContext) -> None:
         """
@@ -175,20 +232,13 @@ class Bot:
         chat_id = update.message.chat_id
         bot = context.bot
         if chat_id in self.context.verified_chats:
-            self.context.button_mode = MODE_ADD_PROJECT
             inline_keyboard = []
             projects = [
                 project
                 for project in self.context.config["gitlab-projects"]
                 if (
                     str(chat_id) in project["user-ids"]
-                    and (
-                        (
-                            project["token"] in self.context.table
-                            and chat_id not in self.context.table[project["token"]]
-                        )
-                        or project["token"] not in self.context.table
-                    )
+                    and not self.context.is_subscribed(chat_id, project["token"])
                 )
             ]
             if len(projects) > 0:
@@ -196,7 +246,11 @@ class Bot:
                     inline_keyboard.append(
                         [
                             InlineKeyboardButton(
-                                text=project["name"], callback_data=project["token"]
+                                text=project["name"],
+                                callback_data=callback_data(
+                                    ACTION_ADD_PROJECT,
+                                    self.context.project_key(project["token"]),
+                                ),
                             )
                         ]
                     )
@@ -221,22 +275,18 @@ class Bot:
         chat_id = update.message.chat_id
         bot = context.bot
         if chat_id in self.context.verified_chats:
-            self.context.button_mode = MODE_CHANGE_VERBOSITY_1
             inline_keyboard = []
-            projects = [
-                project
-                for project in self.context.config["gitlab-projects"]
-                if (
-                    project["token"] in self.context.table
-                    and chat_id in self.context.table[project["token"]]
-                )
-            ]
+            projects = self.context.projects_of(chat_id)
             if len(projects) > 0:
                 for project in projects:
                     inline_keyboard.append(
                         [
                             InlineKeyboardButton(
-                                text=project["name"], callback_data=project["token"]
+                                text=project["name"],
+                                callback_data=callback_data(
+                                    ACTION_CHOOSE_VERBOSITY,
+                                    self.context.project_key(project["token"]),
+                                ),
                             )
                         ]
                     )
@@ -263,22 +313,18 @@ class Bot:
         chat_id = update.message.chat_id
         bot = context.bot
         if chat_id in self.context.verified_chats:
-            self.context.button_mode = MODE_REMOVE_PROJECT
             inline_keyboard = []
-            projects = [
-                project
-                for project in self.context.config["gitlab-projects"]
-                if (
-                    project["token"] in self.context.table
-                    and chat_id in self.context.table[project["token"]]
-                )
-            ]
+            projects = self.context.projects_of(chat_id)
             if len(projects) > 0:
                 for project in projects:
                     inline_keyboard.append(
                         [
                             InlineKeyboardButton(
-                                text=project["name"], callback_data=project["token"]
+                                text=project["name"],
+                                callback_data=callback_data(
+                                    ACTION_REMOVE_PROJECT,
+                                    self.context.project_key(project["token"]),
+                                ),
                             )
                         ]
                     )
@@ -298,59 +344,61 @@ class Bot:
 
     def button(self, update: Update, context: CallbackContext) -> None:
         """
-        Defines the handler for a click on button
+        Defines the handler for a click on button.
+        The callback data carries the action and the project, see callback_data
         """
         query = update.callback_query
         bot = context.bot
-        if self.context.button_mode == MODE_ADD_PROJECT:
-            token = query.data
-            chat_id = query.message.chat_id
-            if token in self.context.table and chat_id in self.context.table[token]:
+        chat_id = query.message.chat_id
+        message_id = query.message.message_id
+        query.answer()
+        action, _, argument = query.data.partition(":")
+        key, _, level = argument.partition(":")
+        project = self.context.project_by_key(key)
+        if chat_id not in self.context.verified_chats or project is None:
+            bot.edit_message_text(
+                text="This menu has expired, please run the command again.",
+                chat_id=chat_id,
+                message_id=message_id,
+            )
+            return
+        token = project["token"]
+        if action == ACTION_ADD_PROJECT:
+            if not self.context.subscribe(chat_id, token, VVVV):
                 bot.edit_message_text(
                     text="Project was already there. Changing nothing.",
                     chat_id=chat_id,
-                    message_id=query.message.message_id,
+                    message_id=message_id,
                 )
             else:
-                if token not in self.context.table:
-                    self.context.table[token] = {}
-                    self.context.table[token][chat_id] = {}
-                self.context.table[token][chat_id]["verbosity"] = VVVV
-                self.context.write_table()
                 bot.edit_message_text(
                     text="The project was successfully added.",
                     chat_id=chat_id,
-                    message_id=query.message.message_id,
+                    message_id=message_id,
                 )
-            self.context.button_mode = MODE_NONE
-        elif self.context.button_mode == MODE_REMOVE_PROJECT:
-            chat_id = query.message.chat_id
-            token = query.data
-            if (
-                token not in self.context.table
-                or chat_id not in self.context.table[token]
-            ):
+        elif action == ACTION_REMOVE_PROJECT:
+            if not self.context.unsubscribe(chat_id, token):
                 bot.edit_message_text(
-                    text="Project was not there. Changing nothing.", chat_id=chat_id
+                    text="Project was not there. Changing nothing.",
+                    chat_id=chat_id,
+                    message_id=message_id,
                 )
             else:
-                del self.context.table[token][chat_id]
-                self.context.write_table()
                 bot.edit_message_text(
                     text="The project was successfully removed.",
                     chat_id=chat_id,
-                    message_id=query.message.message_id,
+                    message_id=message_id,
                 )
-        elif self.context.button_mode == MODE_CHANGE_VERBOSITY_1:
-            chat_id = query.message.chat_id
-            self.context.button_mode = MODE_CHANGE_VERBOSITY_2
-            self.context.selected_project = query.data
+        elif action == ACTION_CHOOSE_VERBOSITY:
             inline_keyboard = []
             for i, verbosity in enumerate(VERBOSITIES):
                 inline_keyboard.append(
                     [
                         InlineKeyboardButton(
-                            text=str(i) + ":" + verbosity[1], callback_data=i + 1
+                            text=str(i) + ":" + verbosity[1],
+                            callback_data=callback_data(
+                                ACTION_SET_VERBOSITY, key, str(verbosity[0])
+                            ),
                         )
                     ]
                 )
@@ -360,47 +408,38 @@ class Bot:
                 message_verbosities += "- " + str(verb[0]) + " : " + verb[1] + "\n"
             bot.edit_message_text(
                 chat_id=chat_id,
-                message_id=query.message.message_id,
+                message_id=message_id,
                 reply_markup=replyKeyboard,
                 text=message_verbosities + "\nChoose the new verbosity.",
             )
-        elif self.context.button_mode == MODE_CHANGE_VERBOSITY_2:
-            chat_id = query.message.chat_id
-            self.context.button_mode = MODE_NONE
-            verbosity = int(query.data) - 1
-            self.context.table[self.context.selected_project][chat_id][
-                "verbosity"
-            ] = verbosity
-            self.context.write_table()
-            bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=query.message.message_id,
-                text="The verbosity of the project has been changed.",
-            )
-            self.context.selected_project = None
-        else:
-            pass
+        elif action == ACTION_SET_VERBOSITY:
+            if self.context.set_verbosity(chat_id, token, int(level)):
+                text = "The verbosity of the project has been changed."
+            else:
+                text = "Project was not there. Changing nothing."
+            bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
 
     def message(self, update: Update, context: CallbackContext) -> None:
         """
         The handler in case a simple message is posted
         """
         bot = context.bot
-        if self.context.wait_for_verification:
+        chat_id = update.message.chat_id
+        if self.context.conversations.get(chat_id) == WAIT_FOR_VERIFICATION:
             if update.message.text == self.context.config["passphrase"]:
-                self.context.verified_chats.append(update.message.chat_id)
-                self.context.write_verified_chats()
+                self.context.conversations.pop(chat_id)
+                self.context.verify_chat(chat_id)
+                self.context.set_chat_bot(chat_id, self.id)
                 bot.send_message(
-                    chat_id=update.message.chat_id,
+                    chat_id=chat_id,
                     text=(
                         "Thank you, your user ID is now verified. Send /help to see the"
                         " available commands."
                     ),
                 )
-                self.context.wait_for_verification = False
             else:
                 bot.send_message(
-                    chat_id=update.message.chat_id,
+                    chat_id=chat_id,
                     text="The passphrase is incorrect. Still waiting for verification.",
                 )
 
@@ -421,20 +460,13 @@ class Bot:
     def list_projects(self, update: Update, context: CallbackContext) -> None:
         chat_id = update.message.chat_id
         bot = context.bot
-        projects = [
-            project
-            for project in self.context.config["gitlab-projects"]
-            if (
-                project["token"] in self.context.table
-                and chat_id in self.context.table[project["token"]]
-            )
-        ]
+        projects = self.context.projects_of(chat_id)
         message = "Projects : \n"
         if len(projects) == 0:
             message += "There is no project"
         for id, project in enumerate(projects):
             message += (
                 f'{id+1} - <b>{project["name"]}</b> (Verbosity:'
-                f' {self.context.table[project["token"]][chat_id]["verbosity"]})\n'
+                f' {self.context.table[project["token"]][chat_id].verbosity})\n'
             )
         bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from classes.metrics import Metrics
+
+CAPTURED_HEADERS = (
+    "Content-Type",
+    "X-Gitlab-Event",
+    "X-Gitlab-Event-UUID",
+    "X-Gitlab-Instance",
+    "X-Gitlab-Token",
+)
+
+
+def redact_token(token: str) -> str:
+    """
+    Replace a project token by a hash, replay.py finds the token back in the config
+    """
+    return "sha256:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+class TrafficCapture:
+    """
+    Write a sample of the received webhooks to rotating gzip JSON lines files.
+    Requests only queue the sample, a background thread compresses and writes it
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sample_rate: float,
+        max_file_size: int = 10 * 1024 * 1024,
+        max_files: int = 10,
+        metrics: Metrics = None,
+    ) -> None:
+        if max_files < 1:
+            raise ValueError("capture max-files must be at least 1")
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.metrics = metrics
+        self.queue = queue.Queue(maxsize=10000)
+        self._path = None
+        self._size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="capture", daemon=True)
+        self.thread.start()
+
+    def record(self, headers, data: bytes) -> None:
+        """
+        Sample a webhook, never blocks the request
+        """
+        if random.random() >= self.sample_rate:
+            return
+        captured = {
+            name: headers[name]
+            for name in CAPTURED_HEADERS
+            if headers[name] is not None
+        }
+        if "X-Gitlab-Token" in captured:
+            captured["X-Gitlab-Token"] = redact_token(captured["X-Gitlab-Token"])
+        entry = {"time": time.time(), "headers": captured, "body": data}
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            if self.metrics:
+                self.metrics.incr("capture_dropped")
+
+    def _rotate(self) -> None:
+        """
+        Start a new file and remove the oldest ones, the new file counting in
+        max_files
+        """
+        self._path = os.path.join(
+            self.directory, time.strftime("capture-%Y%m%d-%H%M%S.jsonl.gz")
+        )
+        self._size = 0
+        files = sorted(
+            name
+            for name in os.listdir(self.directory)
+            if name.startswith("capture-")
+            and name.endswith(".jsonl.gz")
+            and name != os.path.basename(self._path)
+        )
+        for name in files[: max(0, len(files) - self.max_files + 1)]:
+            os.remove(os.path.join(self.directory, name))
+
+    def run(self) -> None:
+        """
+        Write the waiting samples as one gzip member, so that a file is always
+        readable even if the process is killed
+        """
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < 1000:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for entry in entries:
+                    entry["body"] = entry["body"].decode("utf-8", errors="replace")
+                data = gzip.compress(
+                    "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+                )
+                if self._path is None or self._size + len(data) > self.max_file_size:
+                    self._rotate()
+                with open(self._path, "ab") as capture_file:
+                    capture_file.write(data)
+                self._size += len(data)
+                if self.metrics:
+                    self.metrics.incr("captured", len(entries))
+            except Exception:
+                logging.exception("Failed to write capture samples")
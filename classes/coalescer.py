@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Hashable, List
+
+
+class Coalescer:
+    """
+    Group the items received in bursts under the same key.
+    A batch is flushed once no item came for window seconds, after max_delay
+    seconds at most, or as soon as it holds max_batch items
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Hashable, List[Any]], None],
+        window: float = 2,
+        max_batch: int = 50,
+        max_delay: float = 10,
+    ) -> None:
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._batches = {}
+        self._full = []
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="coalescer", daemon=True)
+        self.thread.start()
+
+    def add(self, key: Hashable, item: Any) -> None:
+        """
+        Add an item to the batch of its key
+        """
+        now = time.monotonic()
+        with self._condition:
+            if key not in self._batches:
+                self._batches[key] = {"items": [], "first": now}
+            batch = self._batches[key]
+            batch["items"].append(item)
+            batch["deadline"] = min(now + self.window, batch["first"] + self.max_delay)
+            if len(batch["items"]) >= self.max_batch:
+                self._full.append((key, self._batches.pop(key)["items"]))
+            self._condition.notify()
+
+    def _due(self, now: float) -> list:
+        """
+        Remove and return the batches to flush
+        """
+        due, self._full = self._full, []
+        keys = [key for key, batch in self._batches.items() if batch["deadline"] <= now]
+        return due + [(key, self._batches.pop(key)["items"]) for key in keys]
+
+    def run(self) -> None:
+        """
+        Flush the batches when they are due
+        """
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    due = self._due(now)
+                    if due:
+                        break
+                    deadlines = [batch["deadline"] for batch in self._batches.values()]
+                    self._condition.wait(min(deadlines) - now if deadlines else None)
+            for key, items in due:
+                try:
+                    self.flush(key, items)
+                except Exception:
+                    logging.exception(f"Failed to flush {len(items)} items of {key}")
@@ -4,12 +4,23 @@
 gitlab-webhook-telegram
 """
 
+import hashlib
 import json
 import logging
+import os
 import sys
-from typing import List, Tuple
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Set, Tuple
 
-MODE_NONE = 0
+from classes.conversation import ConversationStore
+from classes.digest import IMMEDIATE
+from classes.metrics import Metrics
+from classes.records import Subscription
+from classes.table import KINDS, Table
+
+DEFAULT_VERBOSITY = 3
 
 
 class Context:
@@ -19,15 +30,36 @@ class Context:
 
     def __init__(self, directory: str) -> None:
         self.directory = directory
-        self.button_mode = MODE_NONE
-        self.wait_for_verification = False
         self.config = None
         self.verified_chats = None
+        self.chat_bots = {}
         self.table = None
+        self.metrics = Metrics()
+        self.dedup = None
+        self.rate_limiter = None
+        self.projects = {}
+        self.project_names = {}
+        self.project_keys = {}
+        self.conversations = None
+        self.note_coalescer = None
+        self.retries = None
+        self.digests = None
+        self.health = None
+        self.breaker = None
+        self.capture = None
+        self.lock = threading.RLock()
+        self._projects_by_chat = None
+        self._batch_depth = 0
+        self._table_dirty = False
+        self._table_changed = False
+        self._write_lock = threading.Lock()
+        self._snapshots = 0
+        self._written = 0
 
-    def get_config(self) -> Tuple[dict, List[int], dict]:
+    def get_config(self) -> Tuple[dict, List[int], Table]:
         """
-        Load the config file and transform it into a python usable var
+        Load the config file and transform it into a python usable var.
+        The table is only read in the background, see Table
         """
         try:
             with open(f"{self.directory}config.json") as config_file:
@@ -73,36 +105,45 @@ class Context:
             logging.critical(str(e))
             sys.exit()
         try:
-            with open(f"{self.directory}chats_projects.json") as table_file:
-                self.table = {}
-                tmp = json.load(table_file)
-                for token in tmp:
-                    self.table[token] = {}
-                    for chat_id in tmp[token]:
-                        self.table[token][int(chat_id)] = tmp[token][chat_id]
+            with open(f"{self.directory}chat_bots.json") as chat_bots_file:
+                self.chat_bots = {
+                    int(chat_id): bot_id
+                    for chat_id, bot_id in json.load(chat_bots_file).items()
+                }
         except FileNotFoundError:
-            logging.warning(
-                f"File {self.directory}chats_projects.json not found. Assuming empty"
-            )
-            self.table = {}
+            self.chat_bots = {}
         except Exception as e:
             logging.critical(
-                f"Unable to read {self.directory}chats_projects.json. Exception follows"
+                f"Unable to read {self.directory}chat_bots.json. Exception follows"
             )
             logging.critical(str(e))
             sys.exit()
+        self.projects = {
+            project["token"]: project for project in self.config["gitlab-projects"]
+        }
+        self.project_names = {
+            project["name"]: project for project in self.config["gitlab-projects"]
+        }
+        self.project_keys = {
+            self.project_key(project["token"]): project
+            for project in self.config["gitlab-projects"]
+        }
+        self.conversations = ConversationStore(
+            self.config.get("conversation-size", 10000),
+            self.config.get("conversation-ttl", 600),
+        )
+        self.table = Table(f"{self.directory}chats_projects.json")
+        self.table.preload()
         return self.config, self.verified_chats, self.table
 
-    def migrate_table_config(self) -> dict:
+    def verify_chat(self, chat_id: int) -> None:
         """
-        Add missing keys to table config file if needed
+        Add a chat to the verified chats and save them
         """
-        for token in self.table:
-            for kind in ("jobs", "pipelines", "merge_requests"):
-                if kind not in self.table[token]:
-                    self.table[token][kind] = {}
-                    logging.info(f"'{kind}' key missing from table, adding now")
-        return self.table
+        with self.lock:
+            if chat_id not in self.verified_chats:
+                self.verified_chats.append(chat_id)
+            self.write_verified_chats()
 
     def write_verified_chats(self) -> None:
         """
@@ -111,19 +152,268 @@ class Context:
         with open(self.directory + "verified_chats.json", "w+") as outfile:
             json.dump(self.verified_chats, outfile)
 
+    def set_chat_bot(self, chat_id: int, bot_id: int) -> None:
+        """
+        Remember the bot a chat talked to, which is a member of the chat, and
+        save it
+        """
+        with self.lock:
+            if self.chat_bots.get(chat_id) == bot_id:
+                return
+            self.chat_bots[chat_id] = bot_id
+            self.write_chat_bots()
+
+    def write_chat_bots(self) -> None:
+        """
+        Save the chat bots file
+        """
+        with open(self.directory + "chat_bots.json", "w+") as outfile:
+            json.dump(self.chat_bots, outfile)
+
     def write_table(self) -> None:
         """
-        Save the verified chats file
+        Save the table file, only once at the end of a batch. Only the snapshot
+        is taken under the lock, a write older than the last one is skipped
+        """
+        with self.lock:
+            if self._batch_depth:
+                self._table_dirty = True
+                return
+            snapshot = self.table.snapshot()
+            self._table_dirty = False
+            self._table_changed = False
+            self._snapshots += 1
+            generation = self._snapshots
+        with self._write_lock:
+            if generation < self._written:
+                return
+            path = self.directory + "chats_projects.json"
+            try:
+                with open(path + ".tmp", "w+") as outfile:
+                    self.table.dump(outfile, snapshot)
+                os.replace(path + ".tmp", path)
+            except Exception:
+                # Saved again by autosave
+                self._table_changed = True
+                raise
+            self._written = generation
+
+    def save_table_later(self) -> None:
         """
-        with open(self.directory + "chats_projects.json", "w+") as outfile:
-            json.dump(self.table, outfile)
+        Mark the tracked objects as changed, the table is written by autosave
+        """
+        self._table_changed = True
+
+    def autosave(self, interval: float) -> None:
+        """
+        Write the table every interval seconds if it changed
+        """
+
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                if self._table_changed:
+                    try:
+                        self.write_table()
+                    except Exception:
+                        logging.exception("Failed to save the table")
+
+        threading.Thread(target=run, name="autosave", daemon=True).start()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Group the table changes made in the block in a single write
+        """
+        with self.lock:
+            self._batch_depth += 1
+            try:
+                yield
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._table_dirty:
+                    self.write_table()
 
     def is_authorized_project(self, token: str) -> bool:
         """
         Test if the token is in the configuration
         """
-        res = False
-        for projet in self.config["gitlab-projects"]:
-            if token == projet["token"]:
-                res = True
-        return res
+        return token in self.projects
+
+    def get_project(self, key: str) -> dict:
+        """
+        Find a configured project by name or token
+        """
+        if key in self.projects:
+            return self.projects[key]
+        return self.project_names.get(key)
+
+    @staticmethod
+    def project_key(token: str) -> str:
+        """
+        Return a short stable id of a project, used instead of its secret token
+        in the inline buttons
+        """
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+    def project_by_key(self, key: str) -> dict:
+        """
+        Find a configured project by its key, see project_key
+        """
+        return self.project_keys.get(key)
+
+    def _chat_index(self) -> Dict[int, Set[str]]:
+        """
+        Return the tokens subscribed by each chat, built on first use
+        """
+        with self.lock:
+            if self._projects_by_chat is None:
+                index = {}
+                for token in self.table:
+                    for chat_id in self.table.chat_ids(token):
+                        index.setdefault(chat_id, set()).add(token)
+                self._projects_by_chat = index
+            return self._projects_by_chat
+
+    def projects_of(self, chat_id: int) -> List[dict]:
+        """
+        Return the configured projects a chat is subscribed to
+        """
+        tokens = self._chat_index().get(chat_id, ())
+        return [project for token, project in self.projects.items() if token in tokens]
+
+    def chats_of(self, token: str) -> List[int]:
+        """
+        Return the chats subscribed to a project
+        """
+        return self.table.chat_ids(token)
+
+    def is_subscribed(self, chat_id: int, token: str) -> bool:
+        """
+        Test if a chat receives the events of a project
+        """
+        return token in self._chat_index().get(chat_id, ())
+
+    def subscribe(
+        self, chat_id: int, token: str, verbosity: int = DEFAULT_VERBOSITY
+    ) -> bool:
+        """
+        Add a project to a chat, return False if it was already there
+        """
+        with self.lock:
+            index = self._chat_index()
+            if token in index.get(chat_id, ()):
+                return False
+            if token not in self.table:
+                self.table[token] = {kind: {} for kind in KINDS}
+            self.table[token][chat_id] = Subscription(verbosity)
+            index.setdefault(chat_id, set()).add(token)
+            self.write_table()
+            return True
+
+    def unsubscribe(self, chat_id: int, token: str) -> bool:
+        """
+        Remove a project from a chat, return False if it was not there
+        """
+        with self.lock:
+            index = self._chat_index()
+            if token not in index.get(chat_id, ()):
+                return False
+            del self.table[token][chat_id]
+            index[chat_id].discard(token)
+            self.write_table()
+            return True
+
+    def _set_option(self, chat_id: int, token: str, key: str, value) -> bool:
+        """
+        Change an option of a subscription, return False if not subscribed
+        """
+        with self.lock:
+            if not self.is_subscribed(chat_id, token):
+                return False
+            setattr(self.table[token][chat_id], key, value)
+            self.write_table()
+            return True
+
+    def set_verbosity(self, chat_id: int, token: str, verbosity: int) -> bool:
+        """
+        Change the verbosity of a project in a chat, return False if not subscribed
+        """
+        return self._set_option(chat_id, token, "verbosity", verbosity)
+
+    def set_issue_replies(self, chat_id: int, token: str, enabled: bool) -> bool:
+        """
+        Choose if issue state changes are also sent as replies to the issue card
+        """
+        return self._set_option(chat_id, token, "issue_replies", enabled)
+
+    def is_suspended(self, chat_id: int) -> bool:
+        """
+        Test if the sending to a chat has been suspended after repeated errors
+        """
+        with self.lock:
+            return any(
+                self.table[token][chat_id].suspended
+                for token in self._chat_index().get(chat_id, ())
+            )
+
+    def suspend_chat(self, chat_id: int, reason: str) -> None:
+        """
+        Stop sending to a chat the bot cannot write to anymore, the reason is
+        saved with each of its subscriptions until they are resumed
+        """
+        suspended = {"reason": reason, "since": int(time.time())}
+        with self.batch():
+            for token in self._chat_index().get(chat_id, ()):
+                self._set_option(chat_id, token, "suspended", suspended)
+
+    def migrate_chat(self, chat_id: int, new_chat_id: int) -> None:
+        """
+        Move the subscriptions and the verification of a group upgraded to a
+        supergroup to its new id
+        """
+        with self.batch():
+            index = self._chat_index()
+            for token in index.pop(chat_id, set()):
+                subscription = self.table[token].pop(chat_id)
+                self.table[token].setdefault(new_chat_id, subscription)
+                index.setdefault(new_chat_id, set()).add(token)
+            self.write_table()
+            if chat_id in self.verified_chats:
+                self.verified_chats.remove(chat_id)
+                if new_chat_id not in self.verified_chats:
+                    self.verified_chats.append(new_chat_id)
+                self.write_verified_chats()
+            if chat_id in self.chat_bots:
+                self.chat_bots[new_chat_id] = self.chat_bots.pop(chat_id)
+                self.write_chat_bots()
+
+    def resume(self, chat_id: int) -> bool:
+        """
+        Send the events of all its projects to a suspended chat again, return
+        False if it was not suspended
+        """
+        with self.batch():
+            tokens = [
+                token
+                for token in self._chat_index().get(chat_id, ())
+                if self.table[token][chat_id].suspended
+            ]
+            for token in tokens:
+                self._set_option(chat_id, token, "suspended", None)
+        return bool(tokens)
+
+    def set_digest(self, chat_id: int, token: str, event: str, mode: str) -> bool:
+        """
+        Choose if an event type is sent immediately or in an hourly or daily
+        digest, return False if not subscribed
+        """
+        with self.lock:
+            if not self.is_subscribed(chat_id, token):
+                return False
+            digests = dict(self.table[token][chat_id].digests or {})
+            if mode == IMMEDIATE:
+                digests.pop(event, None)
+            else:
+                digests[event] = mode
+            return self._set_option(chat_id, token, "digests", digests)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class ConversationStore:
+    """
+    A bounded mapping of conversation states (per chat or per message) which
+    expire ttl seconds after they were last set
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._states = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        while self._states:
+            key, (expires, _) = next(iter(self._states.items()))
+            if expires > now:
+                break
+            del self._states[key]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the state of a conversation
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            if key in self._states:
+                return self._states[key][1]
+            return default
+
+    def set(self, key: Hashable, state: Any) -> None:
+        """
+        Store the state of a conversation, dropping the oldest ones when full
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._states.pop(key, None)
+            self._states[key] = (now + self.ttl, state)
+            if len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove the state of a conversation and return it
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            if key in self._states:
+                return self._states.pop(key)[1]
+            return default
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._states)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from classes.metrics import Metrics
+
+
+def delivery_key(headers, token: str, data: bytes) -> str:
+    """
+    Build the idempotency key of a webhook delivery.
+    GitLab keeps X-Gitlab-Event-UUID across retries, the body hash is the fallback
+    """
+    event = headers["X-Gitlab-Event"] or ""
+    uuid = headers["X-Gitlab-Event-UUID"]
+    if uuid:
+        return f"{event}:{uuid}"
+    digest = hashlib.sha256(token.encode("utf-8") + b"\0" + data).hexdigest()
+    return f"{event}:{digest}"
+
+
+class DedupCache:
+    """
+    A bounded set of recently seen delivery keys with time-based expiry
+    """
+
+    def __init__(
+        self, max_size: int = 10000, ttl: float = 3600, metrics: Metrics = None
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        """
+        Drop expired keys, they are stored by expiry date since the ttl is constant
+        """
+        while self._entries:
+            key, expires = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[key]
+
+    def seen(self, key: str) -> bool:
+        """
+        Return True if the key was already seen, remember it otherwise
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._entries:
+                self.hits += 1
+                hit = True
+            else:
+                self.misses += 1
+                hit = False
+                self._entries[key] = now + self.ttl
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        if self.metrics:
+            self.metrics.incr("dedup_hits" if hit else "dedup_misses")
+        return hit
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+IMMEDIATE = "immediate"
+HOURLY = "hourly"
+DAILY = "daily"
+MODES = (IMMEDIATE, HOURLY, DAILY)
+EVENTS = ("push", "tag", "release", "wiki")
+INTERVALS = {HOURLY: 3600, DAILY: 86400}
+
+
+class Digests:
+    """
+    Buffer one line per event for the chats receiving digests, and call flush
+    with the buffer of a chat once its interval is over. Past max_items, the
+    oldest lines are only counted per project and event.
+    The buffers are saved in path so that digests survive a restart
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush: Callable[[int, str, dict], None],
+        max_items: int = 100,
+        daily_hour: int = 8,
+        save_interval: float = 10,
+    ) -> None:
+        self.path = path
+        self.flush = flush
+        self.max_items = max_items
+        self.daily_offset = daily_hour * 3600
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with open(path) as digests_file:
+                self.buffers = json.load(digests_file)
+        except FileNotFoundError:
+            self.buffers = {}
+        self.thread = threading.Thread(target=self.run, name="digests", daemon=True)
+        self.thread.start()
+
+    def add(self, chat_id: int, mode: str, project: str, event: str, line: str) -> None:
+        """
+        Append a line to the digest of a chat
+        """
+        with self._lock:
+            buffer = self.buffers.setdefault(str(chat_id), {}).setdefault(
+                mode, {"since": time.time(), "items": [], "overflow": {}}
+            )
+            buffer["items"].append([project, event, line])
+            if len(buffer["items"]) > self.max_items:
+                project, event, _ = buffer["items"].pop(0)
+                counts = buffer["overflow"].setdefault(project, {})
+                counts[event] = counts.get(event, 0) + 1
+            self._dirty = True
+
+    def due(self, mode: str, since: float) -> float:
+        """
+        Return the end of the interval containing since, daily digests end at
+        daily_hour UTC
+        """
+        interval = INTERVALS[mode]
+        offset = self.daily_offset if mode == DAILY else 0
+        return ((since - offset) // interval + 1) * interval + offset
+
+    def save(self) -> None:
+        """
+        Write the buffers if they changed
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            with open(self.path + ".tmp", "w") as outfile:
+                json.dump(self.buffers, outfile)
+            os.replace(self.path + ".tmp", self.path)
+            self._dirty = False
+
+    def _pop_due(self, now: float) -> list:
+        """
+        Remove and return the buffers whose interval is over
+        """
+        due = []
+        with self._lock:
+            for chat_id, modes in list(self.buffers.items()):
+                for mode, buffer in list(modes.items()):
+                    if self.due(mode, buffer["since"]) <= now:
+                        due.append((int(chat_id), mode, modes.pop(mode)))
+                if not modes:
+                    del self.buffers[chat_id]
+            if due:
+                self._dirty = True
+        return due
+
+    def run(self) -> None:
+        """
+        Flush the digests at the end of their interval and save the buffers
+        """
+        while True:
+            for chat_id, mode, buffer in self._pop_due(time.time()):
+                try:
+                    self.flush(chat_id, mode, buffer)
+                except Exception:
+                    logging.exception(f"Failed to send the {mode} digest of {chat_id}")
+            try:
+                self.save()
+            except OSError:
+                logging.exception(f"Failed to write {self.path}")
+            time.sleep(self.save_interval)
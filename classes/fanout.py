@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, NamedTuple
+
+
+class Delivery(NamedTuple):
+    """
+    The outcome of a send to one chat
+    """
+
+    chat_id: int
+    result: Any = None
+    error: Exception = None
+
+
+class FanOut:
+    """
+    Run the same delivery for many chats concurrently
+    """
+
+    def __init__(self, workers: int = 8) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="fanout"
+        )
+
+    def _deliver(self, chat_id: int, send: Callable[[int], Any]) -> Delivery:
+        try:
+            return Delivery(chat_id, send(chat_id))
+        except Exception as e:
+            return Delivery(chat_id, error=e)
+
+    def run(
+        self, chat_ids: Iterable[int], send: Callable[[int], Any]
+    ) -> Dict[int, Delivery]:
+        """
+        Call send for every chat and wait for all of them, errors are collected
+        """
+        futures = [
+            self.executor.submit(self._deliver, chat_id, send) for chat_id in chat_ids
+        ]
+        deliveries = [future.result() for future in futures]
+        return {delivery.chat_id: delivery for delivery in deliveries}
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import logging
+import threading
+from typing import Callable
+
+from telegram.error import BadRequest, NetworkError, Unauthorized
+
+from classes.metrics import Metrics
+from classes.retry import describe, is_forbidden
+
+DEAD_CHAT_MESSAGES = (
+    "chat not found",
+    "chat was deactivated",
+    "bot is not a member",
+    "not enough rights to send",
+    "have no rights to send",
+)
+
+
+def is_dead_chat(error: Exception) -> bool:
+    """
+    Test if an error means the bot cannot write to the chat anymore
+    """
+    if is_forbidden(error):
+        return True
+    return isinstance(error, BadRequest) and any(
+        message in str(error).lower() for message in DEAD_CHAT_MESSAGES
+    )
+
+
+def is_outage(error: Exception) -> bool:
+    """
+    Test if an error comes from Telegram being unreachable, or refusing the bot
+    token, rather than from the call itself
+    """
+    if isinstance(error, Unauthorized):
+        return not is_forbidden(error)
+    return isinstance(error, NetworkError) and not isinstance(
+        error, (BadRequest, CircuitOpen)
+    )
+
+
+class CircuitOpen(NetworkError):
+    """
+    Raised instead of calling Telegram while the circuit breaker is open
+    """
+
+    def __init__(self) -> None:
+        super().__init__("Telegram is unreachable, call not attempted")
+
+
+class ChatHealth:
+    """
+    Count the consecutive dead chat errors of each chat and suspend a chat
+    once it reaches max_failures
+    """
+
+    def __init__(
+        self,
+        suspend: Callable[[int, str], None],
+        max_failures: int = 3,
+        metrics: Metrics = None,
+    ) -> None:
+        self.suspend = suspend
+        self.max_failures = max_failures
+        self.metrics = metrics
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def succeeded(self, chat_id: int) -> None:
+        if chat_id in self._failures:
+            with self._lock:
+                self._failures.pop(chat_id, None)
+
+    def failed(self, chat_id: int, error: Exception) -> None:
+        if not is_dead_chat(error):
+            return
+        with self._lock:
+            failures = self._failures.get(chat_id, 0) + 1
+            self._failures[chat_id] = failures
+            if failures < self.max_failures:
+                return
+            del self._failures[chat_id]
+        logging.warning(f"Suspending chat {chat_id} : {describe(error)}")
+        self.suspend(chat_id, describe(error))
+        if self.metrics:
+            self.metrics.incr("chats_suspended")
+
+
+class CircuitBreaker:
+    """
+    Stop calling Telegram after max_failures consecutive outage errors.
+    While open, calls raise CircuitOpen and wait() blocks, and probe is called
+    every probe_interval seconds until it succeeds and closes the circuit
+    """
+
+    def __init__(
+        self,
+        probe: Callable[[], None],
+        max_failures: int = 5,
+        probe_interval: float = 10,
+        metrics: Metrics = None,
+    ) -> None:
+        self.probe = probe
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.metrics = metrics
+        self.is_open = False
+        self._failures = 0
+        self._condition = threading.Condition()
+
+    def check(self) -> None:
+        """
+        Raise CircuitOpen if Telegram should not be called
+        """
+        if self.is_open:
+            raise CircuitOpen()
+
+    def wait(self) -> None:
+        """
+        Block until the circuit is closed
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: not self.is_open)
+
+    def succeeded(self) -> None:
+        self._failures = 0
+
+    def failed(self, error: Exception) -> None:
+        if not is_outage(error):
+            return
+        with self._condition:
+            self._failures += 1
+            if self.is_open or self._failures < self.max_failures:
+                return
+            self.is_open = True
+        logging.error(f"Telegram is unreachable, pausing the calls : {describe(error)}")
+        if self.metrics:
+            self.metrics.incr("circuit_opened")
+            self.metrics.set("circuit_open", 1)
+        threading.Thread(target=self.run, name="probe", daemon=True).start()
+
+    def run(self) -> None:
+        """
+        Probe Telegram until it answers, then close the circuit
+        """
+        while True:
+            with self._condition:
+                self._condition.wait(self.probe_interval)
+            try:
+                self.probe()
+                break
+            except Exception as e:
+                logging.warning(f"Telegram is still unreachable : {describe(e)}")
+        logging.warning("Telegram is reachable again, resuming the calls")
+        with self._condition:
+            self.is_open = False
+            self._failures = 0
+            self._condition.notify_all()
+        if self.metrics:
+            self.metrics.set("circuit_open", 0)
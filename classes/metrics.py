@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """
+    A thread-safe set of named counters, served on the /metrics endpoint
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """
+        Increment the counter called name
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def set(self, name: str, value: int) -> None:
+        """
+        Set a gauge to an absolute value
+        """
+        with self._lock:
+            self._counters[name] = value
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of every counter
+        """
+        with self._lock:
+            return dict(self._counters)
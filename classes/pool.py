@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import bisect
+import hashlib
+from typing import Any, List
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from classes.bot import Bot
+from classes.context import Context
+from classes.fanout import FanOut
+
+REPLICAS = 100
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class BotPool:
+    """
+    Several bots sharing the chats to multiply the outbound throughput.
+    Chats are assigned to a bot by config["chat-bots"], to the bot which
+    handled their /start or verification, or else by consistent hashing on the
+    bot ids, so adding a bot only moves a fraction of the chats
+    """
+
+    def __init__(self, tokens: List[str], context: Context) -> None:
+        self.context = context
+        fanout_workers = context.config.get("fanout-workers", 8) * len(tokens)
+        # Any fan-out thread can call any bot, besides the command workers and
+        # the dispatcher, polling, retry, coalescer, digest and probe threads
+        connections = fanout_workers + context.config.get("bot-workers", 4) + 6
+        self.bots = [Bot(token, context, connections) for token in tokens]
+        self.by_id = {bot.id: bot for bot in self.bots}
+        self.mapping = {
+            int(chat_id): self.bots[index]
+            for chat_id, index in context.config.get("chat-bots", {}).items()
+        }
+        ring = sorted(
+            (_hash(f"{bot.id}:{replica}"), i)
+            for i, bot in enumerate(self.bots)
+            for replica in range(REPLICAS)
+        )
+        self.ring_keys = [key for key, _ in ring]
+        self.ring_bots = [self.bots[i] for _, i in ring]
+        self.fanout = FanOut(fanout_workers)
+
+    def execute(self, operation: dict) -> Any:
+        """
+        Execute an operation described by handlers.operation
+        """
+        method = operation["method"]
+        chat_id = operation["chat_id"]
+        bot_id = operation.get("bot_id")
+        markup = operation.get("markup")
+        if markup is not None:
+            markup = InlineKeyboardMarkup.de_json(markup, None)
+        if method == "send_message":
+            return self.send_message(
+                chat_id,
+                operation["message"],
+                markup,
+                operation.get("reply_to"),
+                bot_id,
+                operation.get("sent"),
+            )
+        try:
+            if method == "edit_message_reply_markup":
+                self.edit_message_reply_markup(
+                    chat_id, operation["message_id"], markup, bot_id
+                )
+            elif method == "edit_message_text":
+                self.edit_message_text(
+                    chat_id,
+                    operation["message_id"],
+                    operation["message"],
+                    markup,
+                    bot_id,
+                )
+            else:
+                raise ValueError(f"Unknown operation {method}")
+        except BadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        return None
+
+    def bot_for(self, chat_id: int) -> Bot:
+        """
+        Return the bot talking to a chat
+        """
+        if chat_id in self.mapping:
+            return self.mapping[chat_id]
+        bot = self.by_id.get(self.context.chat_bots.get(chat_id))
+        if bot is not None:
+            return bot
+        index = bisect.bisect(self.ring_keys, _hash(str(chat_id)))
+        return self.ring_bots[index % len(self.ring_bots)]
+
+    def owner(self, chat_id: int, bot_id: int = None) -> Bot:
+        """
+        Return the bot which sent a message, or the bot of the chat if unknown
+        """
+        if bot_id in self.by_id:
+            return self.by_id[bot_id]
+        return self.bot_for(chat_id)
+
+    def send_message(
+        self,
+        chat_id: int,
+        message: str,
+        markup: InlineKeyboardMarkup = None,
+        reply_to: int = None,
+        bot_id: int = None,
+        sent: List[int] = None,
+    ) -> List[int]:
+        """
+        Send a message through the bot of the chat, or the bot which sent the
+        message it replies to
+        """
+        return self.owner(chat_id, bot_id).send_message(
+            chat_id, message, markup, reply_to, sent
+        )
+
+    def edit_message_reply_markup(
+        self,
+        chat_id: int,
+        message_id: int,
+        markup: InlineKeyboardMarkup,
+        bot_id: int = None,
+    ) -> None:
+        """
+        Replace the inline keyboard of a message through the bot which sent it
+        """
+        self.owner(chat_id, bot_id).edit_message_reply_markup(
+            chat_id, message_id, markup
+        )
+
+    def edit_message_text(
+        self,
+        chat_id: int,
+        message_id: int,
+        message: str,
+        markup: InlineKeyboardMarkup = None,
+        bot_id: int = None,
+    ) -> None:
+        """
+        Replace the text of a message through the bot which sent it
+        """
+        self.owner(chat_id, bot_id).edit_message_text(
+            chat_id, message_id, message, markup
+        )
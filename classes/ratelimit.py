@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import threading
+import time
+
+from classes.metrics import Metrics
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at rate tokens per second, holding at most burst tokens
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, count: int = 1) -> bool:
+        """
+        Take count tokens if available, never wait
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= count:
+                self.tokens -= count
+                return True
+            return False
+
+    def acquire(self, count: int = 1) -> None:
+        """
+        Take count tokens, waiting for the bucket to refill if needed
+        """
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                delay = (count - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Admission control with one token bucket per project token
+    """
+
+    def __init__(
+        self, rate: float, burst: int, overrides: dict = None, metrics: Metrics = None
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides or {}
+        self.metrics = metrics
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            if key not in self._buckets:
+                limits = self.overrides.get(key, {})
+                self._buckets[key] = TokenBucket(
+                    limits.get("rate", self.rate), limits.get("burst", self.burst)
+                )
+            return self._buckets[key]
+
+    def allow(self, key: str) -> bool:
+        """
+        Return True if an event for key can be accepted now
+        """
+        allowed = self._bucket(key).try_acquire()
+        if not allowed and self.metrics:
+            self.metrics.incr("rejected_rate_limit")
+        return allowed
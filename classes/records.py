@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+_STATUSES: List[str] = []
+_CODES: Dict[str, int] = {}
+_CODES_LOCK = threading.Lock()
+_INTERNED: dict = {}
+
+
+def status_code(status: str) -> int:
+    """
+    Return the small integer standing for a status, statuses are few
+    """
+    code = _CODES.get(status)
+    if code is None:
+        with _CODES_LOCK:
+            if status not in _CODES:
+                _STATUSES.append(status)
+                _CODES[status] = len(_STATUSES) - 1
+            code = _CODES[status]
+    return code
+
+
+def intern(value):
+    """
+    Share the chat and bot ids repeated in every record
+    """
+    return _INTERNED.setdefault(value, value)
+
+
+def encode(record) -> dict:
+    """
+    The default of json.dump for the table records
+    """
+    return record.to_json()
+
+
+class Subscription:
+    """
+    The options of a project in a chat
+    """
+
+    __slots__ = ("verbosity", "issue_replies", "digests", "suspended")
+
+    def __init__(
+        self,
+        verbosity: int,
+        issue_replies: bool = False,
+        digests: dict = None,
+        suspended: dict = None,
+    ) -> None:
+        self.verbosity = verbosity
+        self.issue_replies = issue_replies
+        self.digests = digests or None
+        self.suspended = suspended
+
+    def copy(self) -> "Subscription":
+        return Subscription(
+            self.verbosity, self.issue_replies, self.digests, self.suspended
+        )
+
+    @classmethod
+    def from_json(cls, raw: dict) -> "Subscription":
+        return cls(
+            raw["verbosity"],
+            raw.get("issue_replies", False),
+            raw.get("digests"),
+            raw.get("suspended"),
+        )
+
+    def to_json(self) -> dict:
+        raw = {"verbosity": self.verbosity}
+        if self.issue_replies:
+            raw["issue_replies"] = True
+        if self.digests:
+            raw["digests"] = self.digests
+        if self.suspended:
+            raw["suspended"] = self.suspended
+        return raw
+
+
+class Tracked:
+    """
+    A job, pipeline, merge request or issue and its message in each chat.
+    The status is stored as a code and the chats in a flat tuple of
+    (chat id, message ids, bot id, content hash) groups, the chat id None
+    standing for the single message_id of old tables. The revision counts the
+    events received for the object
+    """
+
+    __slots__ = ("code", "chats", "revision")
+
+    def __init__(self, status: str, chats: tuple = (), revision: int = 0) -> None:
+        self.code = status_code(status)
+        self.chats = chats
+        self.revision = revision
+
+    @property
+    def status(self) -> str:
+        return _STATUSES[self.code]
+
+    @status.setter
+    def status(self, status: str) -> None:
+        self.code = status_code(status)
+
+    def _find(self, chat_id: Optional[int]) -> int:
+        """
+        Return the position of the group of a chat, -1 if there is none
+        """
+        chats = self.chats
+        for i in range(0, len(chats), 4):
+            if chats[i] == chat_id:
+                return i
+        return -1
+
+    def message_id(self, chat_id: int) -> Optional[int]:
+        """
+        Return the last message displaying the object in a chat
+        """
+        i = self._find(chat_id)
+        if i < 0 or self.chats[i + 1] is None:
+            i = self._find(None)
+        if i < 0:
+            return None
+        messages = self.chats[i + 1]
+        return messages[-1] if isinstance(messages, tuple) else messages
+
+    def bot_id(self, chat_id: int) -> Optional[int]:
+        i = self._find(chat_id)
+        return self.chats[i + 2] if i >= 0 else None
+
+    def hash(self, chat_id: int) -> Optional[str]:
+        i = self._find(chat_id)
+        if i < 0 or self.chats[i + 3] is None:
+            return None
+        return f"{self.chats[i + 3]:016x}"
+
+    def update(
+        self,
+        chat_id: int,
+        message_ids: List[int] = None,
+        bot_id: int = None,
+        hash: str = None,
+    ) -> None:
+        """
+        Remember the messages, bot or content hash of a chat, None keeps the
+        current value
+        """
+        i = self._find(chat_id)
+        group = (
+            list(self.chats[i : i + 4]) if i >= 0 else [intern(chat_id), *3 * [None]]
+        )
+        if message_ids is not None:
+            group[1] = message_ids[0] if len(message_ids) == 1 else tuple(message_ids)
+        if bot_id is not None:
+            group[2] = intern(bot_id)
+        if hash is not None:
+            group[3] = int(hash, 16)
+        if i >= 0:
+            self.chats = self.chats[:i] + tuple(group) + self.chats[i + 4 :]
+        else:
+            self.chats += tuple(group)
+
+    def copy(self) -> "Tracked":
+        record = Tracked.__new__(Tracked)
+        record.code, record.chats = self.code, self.chats
+        record.revision = self.revision
+        return record
+
+    @classmethod
+    def from_json(cls, raw: dict) -> "Tracked":
+        record = cls(raw.get("status"), revision=raw.get("revision", 0))
+        if "message_id" in raw:
+            record.chats = (None, raw["message_id"], None, None)
+        messages, bots = raw.get("messages", {}), raw.get("bots", {})
+        hashes = raw.get("hashes", {})
+        for chat in {**messages, **bots, **hashes}:
+            record.update(
+                int(chat), messages.get(chat), bots.get(chat), hashes.get(chat)
+            )
+        return record
+
+    def to_json(self) -> dict:
+        raw = {"status": self.status}
+        if self.revision:
+            raw["revision"] = self.revision
+        messages, bots, hashes = {}, {}, {}
+        for i in range(0, len(self.chats), 4):
+            chat, message_ids, bot_id, hash = self.chats[i : i + 4]
+            if chat is None:
+                raw["message_id"] = message_ids
+                continue
+            if message_ids is not None:
+                messages[str(chat)] = (
+                    list(message_ids)
+                    if isinstance(message_ids, tuple)
+                    else [message_ids]
+                )
+            if bot_id is not None:
+                bots[str(chat)] = bot_id
+            if hash is not None:
+                hashes[str(chat)] = f"{hash:016x}"
+        for key, value in (("messages", messages), ("bots", bots), ("hashes", hashes)):
+            if value:
+                raw[key] = value
+        return raw
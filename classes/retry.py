@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, Unauthorized
+
+from classes.metrics import Metrics
+
+PERMANENT_ERRORS = (BadRequest, ChatMigrated, Unauthorized)
+
+
+def describe(error: Exception) -> str:
+    """
+    Return the type and message of an error, Telegram errors have an empty repr
+    """
+    return f"{type(error).__name__}: {error}"
+
+
+def is_forbidden(error: Exception) -> bool:
+    """
+    Test if Telegram refused the bot in a chat (HTTP 403), rather than refusing
+    the bot token itself (HTTP 401), both raise Unauthorized
+    """
+    return isinstance(error, Unauthorized) and str(error).lower().startswith(
+        "forbidden"
+    )
+
+
+def is_permanent(error: Exception) -> bool:
+    """
+    Test if retrying an operation that raised error cannot succeed. A refused
+    bot token is left to the circuit breaker
+    """
+    if isinstance(error, Unauthorized):
+        return is_forbidden(error)
+    return isinstance(error, PERMANENT_ERRORS)
+
+
+def operation_key(operation: dict) -> Optional[tuple]:
+    """
+    Return what identifies the message an operation on a tracked object
+    updates, None for the other operations
+    """
+    track = operation.get("track")
+    if track is None:
+        return None
+    return (
+        track["token"],
+        track["kind"],
+        str(track["id"]),
+        operation["chat_id"],
+        operation["method"],
+    )
+
+
+class RetryScheduler:
+    """
+    Retry the failed Telegram operations with exponential backoff and jitter.
+    Pending retries are kept in a heap ordered by due date. Operations failing
+    max_attempts times, or with a permanent error, go to the dead letters file.
+    A failed operation on a tracked object replaces the one pending for the
+    same message, which is outdated
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[dict], Any],
+        path: str,
+        max_attempts: int = 5,
+        base_delay: float = 2,
+        max_delay: float = 300,
+        metrics: Metrics = None,
+    ) -> None:
+        self.execute = execute
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics
+        self._heap = []
+        self._keys = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._file_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="retry", daemon=True)
+        self.thread.start()
+
+    def _incr(self, name: str) -> None:
+        if self.metrics:
+            self.metrics.incr(name)
+
+    def delay(self, attempts: int, error: Exception = None) -> float:
+        """
+        Return the time to wait before the next attempt, with full jitter
+        """
+        if isinstance(error, RetryAfter):
+            return error.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempts))
+
+    def failed(self, operation: dict, error: Exception, attempts: int = 1) -> None:
+        """
+        Schedule the retry of an operation that failed attempts times
+        """
+        if is_permanent(error) or attempts >= self.max_attempts:
+            self._forget(operation)
+            self.dead_letter(operation, error, attempts)
+            return
+        due = time.monotonic() + self.delay(attempts, error)
+        key = operation_key(operation)
+        with self._condition:
+            if key is not None:
+                current = self._keys.get(key)
+                if attempts > 1 and current is not operation:
+                    # A newer operation was scheduled while this one was retried
+                    return
+                if current is not None and current is not operation:
+                    self._heap = [
+                        entry for entry in self._heap if entry[3] is not current
+                    ]
+                    heapq.heapify(self._heap)
+                self._keys[key] = operation
+            heapq.heappush(self._heap, (due, next(self._counter), attempts, operation))
+            self._condition.notify()
+        self._incr("retries_scheduled")
+
+    def _forget(self, operation: dict) -> None:
+        """
+        Unregister an operation which is not pending anymore
+        """
+        key = operation_key(operation)
+        with self._condition:
+            if key is not None and self._keys.get(key) is operation:
+                del self._keys[key]
+
+    def pending(self) -> int:
+        """
+        Return the number of operations waiting for a retry
+        """
+        with self._condition:
+            return len(self._heap)
+
+    def run(self) -> None:
+        """
+        Execute the operations when they are due
+        """
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = (
+                        self._heap[0][0] - time.monotonic() if self._heap else None
+                    )
+                    self._condition.wait(timeout)
+                _, _, attempts, operation = heapq.heappop(self._heap)
+            try:
+                self.execute(operation)
+                self._forget(operation)
+                self._incr("retries_succeeded")
+            except Exception as e:
+                logging.warning(
+                    f"Attempt {attempts + 1} of {operation['method']} to chat"
+                    f" {operation['chat_id']} failed : {describe(e)}"
+                )
+                self.failed(operation, e, attempts + 1)
+
+    def dead_letter(self, operation: dict, error: Exception, attempts: int) -> None:
+        """
+        Append an operation to the dead letters file
+        """
+        logging.error(
+            f"Giving up {operation['method']} to chat {operation['chat_id']} after"
+            f" {attempts} attempt(s) : {describe(error)}"
+        )
+        entry = {
+            "operation": operation,
+            "error": describe(error),
+            "attempts": attempts,
+            "time": time.time(),
+        }
+        with self._file_lock:
+            with open(self.path, "a") as dead_letters_file:
+                dead_letters_file.write(json.dumps(entry) + "\n")
+        self._incr("dead_letters")
+
+    def _read(self) -> List[dict]:
+        try:
+            with open(self.path) as dead_letters_file:
+                return [json.loads(line) for line in dead_letters_file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def dead_letters(self) -> List[dict]:
+        """
+        Return the content of the dead letters file
+        """
+        with self._file_lock:
+            return self._read()
+
+    def replay(self) -> int:
+        """
+        Empty the dead letters file and retry its operations right away. Only
+        the last operation on a tracked message is kept, none if a newer one
+        is pending
+        """
+        with self._file_lock:
+            entries = self._read()
+            open(self.path, "w").close()
+        operations = {}
+        for i, entry in enumerate(entries):
+            key = operation_key(entry["operation"])
+            operations[key if key is not None else i] = entry["operation"]
+        now = time.monotonic()
+        with self._condition:
+            for key, operation in operations.items():
+                if isinstance(key, tuple):
+                    if key in self._keys:
+                        continue
+                    self._keys[key] = operation
+                heapq.heappush(self._heap, (now, next(self._counter), 0, operation))
+            self._condition.notify()
+        return len(entries)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import re
+from html import unescape
+from typing import List
+
+MAX_MESSAGE_LENGTH = 4096
+
+TOKENS = re.compile(r"<[^<>]*>|&#?\w+;|\n|[^<&\n]+|[<&]")
+TAG = re.compile(r"<(/?)\s*([a-zA-Z][\w-]*)")
+
+
+def utf16_length(text: str) -> int:
+    """
+    Return the length of a string as counted by Telegram
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def visible_text(message: str) -> str:
+    """
+    Return the text of an HTML message as displayed, without the tags
+    """
+    return unescape(re.sub(r"<[^<>]*>", "", message))
+
+
+def _cut(text: str, start: int, units: int) -> int:
+    """
+    Return the end of the longest slice of text from start fitting in units
+    UTF-16 units
+    """
+    end = min(len(text), start + max(units, 0))
+    if utf16_length(text[start:end]) == end - start:
+        # No surrogate pair, one unit per character
+        return end
+    for index in range(start, len(text)):
+        units -= 2 if ord(text[index]) > 0xFFFF else 1
+        if units < 0:
+            return index
+    return len(text)
+
+
+def split_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Split an HTML message in parts of at most limit UTF-16 units of text.
+    Parts are cut on line breaks when possible and tags left open at the end
+    of a part are closed, then opened again at the start of the next one
+    """
+    if len(message) * 2 <= limit or utf16_length(message) <= limit:
+        return [message]
+    parts = []
+    stack = []
+    pieces = []
+    units = 0
+    last_break = None
+
+    def close(tags: list) -> str:
+        return "".join(f"</{name}>" for name, _ in reversed(tags))
+
+    def reopen(tags: list) -> str:
+        return "".join(tag for _, tag in tags)
+
+    def emit(part: str) -> None:
+        # Telegram refuses a message without text, markup and spaces only
+        if visible_text(part).strip():
+            parts.append(part)
+
+    def flush() -> None:
+        nonlocal pieces, units, last_break
+        emit("".join(pieces) + close(stack))
+        pieces = [reopen(stack)]
+        units = 0
+        last_break = None
+
+    for match in TOKENS.finditer(message):
+        token = match.group()
+        tag = TAG.match(token) if token.startswith("<") else None
+        if tag:
+            pieces.append(token)
+            if not tag.group(1):
+                stack.append((tag.group(2).lower(), token))
+            else:
+                name = tag.group(2).lower()
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i][0] == name:
+                        del stack[i:]
+                        break
+            continue
+        if token == "\n":
+            if units + 1 > limit:
+                flush()
+                continue
+            last_break = (len(pieces), units, list(stack))
+            pieces.append(token)
+            units += 1
+            continue
+        size = utf16_length(unescape(token)) if token.startswith("&") else None
+        if size is None:
+            size = utf16_length(token)
+        if units + size <= limit:
+            pieces.append(token)
+            units += size
+            continue
+        if last_break is not None and last_break[1] > 0:
+            index, break_units, break_stack = last_break
+            rest = pieces[index + 1 :]
+            emit("".join(pieces[:index]) + close(break_stack))
+            pieces = [reopen(break_stack)] + rest
+            units -= break_units + 1
+            last_break = None
+            if units + size <= limit:
+                pieces.append(token)
+                units += size
+                continue
+        if token.startswith("&"):
+            flush()
+            pieces.append(token)
+            units += size
+            continue
+        # Walk a long line with an offset, slicing the rest each time would
+        # copy it once per part
+        start = 0
+        while units + size > limit:
+            end = _cut(token, start, limit - units)
+            if end == start and units == 0:
+                end = start + 1
+            piece = token[start:end]
+            pieces.append(piece)
+            size -= utf16_length(piece)
+            start = end
+            flush()
+        pieces.append(token[start:])
+        units += size
+    emit("".join(pieces))
+    return parts or [message]
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import json
+import logging
+import os
+import threading
+from collections.abc import MutableMapping
+from typing import IO, Iterator, List
+
+from classes.records import Subscription, Tracked, encode, intern
+
+KINDS = ("jobs", "pipelines", "merge_requests", "issues")
+
+
+def _int_key(key: str):
+    """
+    Convert a JSON key back to the integer id it was created from
+    """
+    try:
+        return int(key)
+    except ValueError:
+        return key
+
+
+class Table(MutableMapping):
+    """
+    The chats and tracked objects of every project, read from chats_projects.json.
+    The file is parsed in the background and each project is only rebuilt on its
+    first access
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._raw = None
+        self._projects = {}
+        self._loaded = threading.Event()
+        self._lock = threading.RLock()
+
+    def preload(self) -> None:
+        """
+        Start reading the file without waiting for it
+        """
+        threading.Thread(target=self._load, name="table", daemon=True).start()
+
+    def _load(self) -> None:
+        """
+        Parse the file once, wait for it if another thread is already parsing it
+        """
+        if self._loaded.is_set():
+            return
+        with self._lock:
+            if self._loaded.is_set():
+                return
+            try:
+                with open(self.path) as table_file:
+                    self._raw = json.load(table_file)
+            except FileNotFoundError:
+                logging.warning(f"File {self.path} not found. Assuming empty")
+                self._raw = {}
+            except Exception as e:
+                logging.critical(f"Unable to read {self.path}. Exception follows")
+                logging.critical(str(e))
+                # Never run with a partial table, it would be written back
+                os._exit(1)
+            self._loaded.set()
+
+    def _project(self, token: str) -> dict:
+        """
+        Return the rebuilt project, converting it from the file on first access
+        """
+        self._load()
+        with self._lock:
+            if token not in self._projects:
+                if token not in self._raw:
+                    raise KeyError(token)
+                self._projects[token] = self._rebuild(self._raw.pop(token))
+            return self._projects[token]
+
+    @staticmethod
+    def _rebuild(raw: dict) -> dict:
+        """
+        Restore the integer chat and object ids, compact the records and add the
+        missing kinds
+        """
+        project = {}
+        for key, value in raw.items():
+            if key in KINDS:
+                project[key] = {
+                    _int_key(id): Tracked.from_json(record)
+                    for id, record in value.items()
+                }
+            else:
+                project[intern(_int_key(key))] = Subscription.from_json(value)
+        for kind in KINDS:
+            if kind not in project:
+                project[kind] = {}
+                logging.info(f"'{kind}' key missing from table, adding now")
+        return project
+
+    def __getitem__(self, token: str) -> dict:
+        return self._project(token)
+
+    def __setitem__(self, token: str, project: dict) -> None:
+        self._load()
+        with self._lock:
+            self._raw.pop(token, None)
+            self._projects[token] = project
+
+    def __delitem__(self, token: str) -> None:
+        self._load()
+        with self._lock:
+            if token not in self._projects and token not in self._raw:
+                raise KeyError(token)
+            self._raw.pop(token, None)
+            self._projects.pop(token, None)
+
+    def __contains__(self, token: object) -> bool:
+        self._load()
+        with self._lock:
+            return token in self._projects or token in self._raw
+
+    def __iter__(self) -> Iterator[str]:
+        self._load()
+        with self._lock:
+            return iter(list(self._projects) + list(self._raw))
+
+    def __len__(self) -> int:
+        self._load()
+        with self._lock:
+            return len(self._projects) + len(self._raw)
+
+    def chat_ids(self, token: str) -> List[int]:
+        """
+        Return the chats of a project without rebuilding it
+        """
+        self._load()
+        with self._lock:
+            if token in self._projects:
+                return [key for key in self._projects[token] if key not in KINDS]
+            if token in self._raw:
+                return [int(key) for key in self._raw[token] if key not in KINDS]
+            return []
+
+    def to_json(self) -> dict:
+        """
+        Return the whole table, the records are converted by encode
+        """
+        self._load()
+        with self._lock:
+            return {**self._raw, **self._projects}
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of the whole table that later changes do not affect, so
+        that it can be written without holding the locks
+        """
+        self._load()
+        with self._lock:
+            table = dict(self._raw)
+            for token, project in self._projects.items():
+                table[token] = {
+                    key: (
+                        {id: record.copy() for id, record in value.items()}
+                        if key in KINDS
+                        else value.copy()
+                    )
+                    for key, value in project.items()
+                }
+            return table
+
+    def dump(self, outfile: IO[str], snapshot: dict = None) -> None:
+        """
+        Write the table, or a snapshot of it, in the format of
+        chats_projects.json
+        """
+        table = snapshot if snapshot is not None else self.to_json()
+        outfile.write(json.dumps(table, default=encode))
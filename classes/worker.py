@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+"""
+
+import logging
+import queue
+import threading
+from typing import Callable, NamedTuple
+
+from classes.context import Context
+
+LOW = 0
+NORMAL = 1
+HIGH = 2
+
+PRIORITY_NAMES = {LOW: "low", NORMAL: "normal", HIGH: "high"}
+
+
+class Event(NamedTuple):
+    """
+    A webhook accepted by the server and waiting to be handled
+    """
+
+    type: str
+    body: dict
+    token: str
+    key: str
+    priority: int
+
+
+class Worker:
+    """
+    Handle the accepted webhooks in order, outside of the request thread.
+    Events are shed by priority when the queue grows too long
+    """
+
+    def __init__(self, context: Context, thresholds: dict) -> None:
+        self.context = context
+        self.process = None
+        self.thresholds = {
+            LOW: thresholds.get("low", 500),
+            NORMAL: thresholds.get("normal", 2000),
+        }
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="worker", daemon=True)
+
+    def start(self, process: Callable[[Event], None]) -> None:
+        """
+        Start handling events in the background, events submitted before are
+        kept in the queue until then
+        """
+        self.process = process
+        self.thread.start()
+
+    def submit(self, event: Event) -> bool:
+        """
+        Queue an event, return False if it has been shed
+        """
+        threshold = self.thresholds.get(event.priority)
+        if threshold is not None and self.queue.qsize() >= threshold:
+            name = PRIORITY_NAMES[event.priority]
+            logging.warning(f"Queue is full, dropping {name} priority {event.type}")
+            self.context.metrics.incr(f"rejected_shed_{name}")
+            return False
+        self.queue.put(event)
+        self.context.metrics.set("queue_depth", self.queue.qsize())
+        return True
+
+    def run(self) -> None:
+        """
+        Consume the queue forever
+        """
+        while True:
+            if self.context.breaker is not None:
+                # Events wait in the queue while Telegram is unreachable
+                self.context.breaker.wait()
+            event = self.queue.get()
+            try:
+                self.process(event)
+            except Exception:
+                logging.exception(f"Failed to handle {event.type} ({event.key})")
+            finally:
+                self.queue.task_done()
+                self.context.metrics.set("queue_depth", self.queue.qsize())
@@ -2,13 +2,21 @@
 This file defines all the handlers needed by the server
 """
 
+import hashlib
+import html
+import json
 import logging
-from typing import List
+from typing import Callable, Dict, List, Tuple
 
 from emoji import emojize
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import ChatMigrated
 
-from classes.bot import Bot
+from classes.context import Context
+from classes.digest import IMMEDIATE
+from classes.pool import BotPool
+from classes.records import Tracked
+from classes.retry import describe
 
 V = 0
 VV = 1
@@ -33,115 +41,595 @@ STATUSES = {
     "waiting_for_resource": emojize("Waiting :timer_clock:"),
 }
 
+MAX_CARD_DESCRIPTION = 1000
+MAX_DIGEST_LINE = 200
 
-def push_handler(data: dict, bot: Bot, chats: List[int], project_token: str) -> None:
+
+def operation(
+    method: str, chat_id: int, markup: InlineKeyboardMarkup = None, **arguments
+) -> dict:
     """
-    Defines the handler for when a commit event is received
+    Describe a Telegram call, so that it can be retried or saved as dead letter
+    """
+    described = {"method": method, "chat_id": chat_id, **arguments}
+    if markup is not None:
+        described["markup"] = markup.to_dict()
+    return described
+
+
+def delivered(bot: BotPool, operation: dict, result: List[int]) -> None:
+    """
+    Remember the message sent for a tracked object, the bot which sent it and
+    the hash of what it displays
+    """
+    track = operation.get("track")
+    if track is None:
+        return
+    chat_id = operation["chat_id"]
+    with bot.context.lock:
+        project = bot.context.table.get(track["token"], {})
+        record = project.get(track["kind"], {}).get(track["id"])
+        if record is None:
+            return
+        record.update(
+            chat_id,
+            result,
+            bot.bot_for(chat_id).id if result is not None else None,
+            operation.get("hash"),
+        )
+        bot.context.save_table_later()
+
+
+def execute(bot: BotPool, operation: dict) -> None:
     """
+    Execute an operation unless Telegram is unreachable, and keep track of the
+    health of Telegram and of the chat
+    """
+    context = bot.context
+    if context.breaker is not None:
+        context.breaker.check()
+    try:
+        result = bot.execute(operation)
+    except Exception as e:
+        if getattr(e, "message_ids", None):
+            # Only the parts left are sent again
+            operation["sent"] = e.message_ids
+        if context.breaker is not None:
+            context.breaker.failed(e)
+        if context.health is not None:
+            context.health.failed(operation["chat_id"], e)
+        if isinstance(e, ChatMigrated):
+            # The group became a supergroup, follow it and send there instead
+            logging.warning(f"Chat {operation['chat_id']} moved to {e.new_chat_id}")
+            context.migrate_chat(operation["chat_id"], e.new_chat_id)
+            if operation["method"] == "send_message":
+                execute(bot, {**operation, "chat_id": e.new_chat_id})
+                return
+        raise
+    if context.breaker is not None:
+        context.breaker.succeeded()
+    if context.health is not None:
+        context.health.succeeded(operation["chat_id"])
+    delivered(bot, operation, result)
+
+
+def is_stale(bot: BotPool, operation: dict) -> bool:
+    """
+    Test if a tracked object received another event since an operation was
+    built, in which case the operation is outdated. The content hash cannot
+    tell, a later event can render the content displayed before
+    """
+    track = operation.get("track")
+    if track is None or "base" not in operation:
+        return False
+    with bot.context.lock:
+        project = bot.context.table.get(track["token"], {})
+        record = project.get(track["kind"], {}).get(track["id"])
+        return record is not None and record.revision != operation["base"]
+
+
+def retry(bot: BotPool, operation: dict) -> None:
+    """
+    Execute a retried operation, waiting for Telegram to be reachable
+    """
+    if bot.context.breaker is not None:
+        bot.context.breaker.wait()
+    if bot.context.is_suspended(operation["chat_id"]):
+        logging.info(f"Chat {operation['chat_id']} is suspended, retry dropped")
+        return
+    if is_stale(bot, operation):
+        logging.info(f"{operation['method']} to chat {operation['chat_id']} outdated")
+        return
+    execute(bot, operation)
+
+
+def run_operations(bot: BotPool, operations: Dict[int, List[dict]]) -> None:
+    """
+    Execute the operations of each chat in order, all the chats concurrently.
+    Failed operations are handed to the retry scheduler
+    """
+
+    def deliver(chat_id: int) -> None:
+        if bot.context.is_suspended(chat_id):
+            logging.info(f"Chat {chat_id} is suspended, nothing sent")
+            return
+        for operation in operations[chat_id]:
+            try:
+                execute(bot, operation)
+            except Exception as e:
+                logging.error(
+                    f"{operation['method']} to chat {chat_id} failed : {describe(e)}"
+                )
+                if bot.context.retries is not None:
+                    bot.context.retries.failed(operation, e)
+
+    bot.fanout.run(operations, deliver)
+
+
+def render_per_verbosity(
+    chats: List[dict], render: Callable[[int], str]
+) -> Dict[int, str]:
+    """
+    Render a message once for each verbosity used by the chats
+    """
+    messages = {}
     for chat in chats:
-        for commit in data["commits"]:
+        if chat["verbosity"] not in messages:
+            messages[chat["verbosity"]] = render(chat["verbosity"])
+    return messages
+
+
+def send_to_chats(
+    bot: BotPool,
+    chats: List[dict],
+    render: Callable[[int], str],
+    markup: InlineKeyboardMarkup = None,
+) -> None:
+    """
+    Render the message once per verbosity and send it to all the chats concurrently
+    """
+    messages = render_per_verbosity(chats, render)
+    run_operations(
+        bot,
+        {
+            chat["id"]: [
+                operation(
+                    "send_message",
+                    chat["id"],
+                    markup,
+                    message=messages[chat["verbosity"]],
+                )
+            ]
+            for chat in chats
+        },
+    )
+
+
+def send_or_digest(
+    bot: BotPool,
+    chats: List[dict],
+    event: str,
+    project: str,
+    render: Callable[[int], str],
+    line: str,
+) -> None:
+    """
+    Send the message to the chats receiving the event type immediately, and add
+    a line to the digest of the others, escaped as the digest is sent as HTML
+    """
+    if len(line) > MAX_DIGEST_LINE:
+        line = line[:MAX_DIGEST_LINE] + "…"
+    line, project = html.escape(line), html.escape(project)
+    immediate = []
+    for chat in chats:
+        mode = chat.get("digests", {}).get(event, IMMEDIATE)
+        if mode == IMMEDIATE or bot.context.digests is None:
+            immediate.append(chat)
+        else:
+            bot.context.digests.add(chat["id"], mode, project, event, line)
+    if immediate:
+        send_to_chats(bot, immediate, render)
+
+
+def send_digest(bot: BotPool, chat_id: int, mode: str, buffer: dict) -> None:
+    """
+    Send the lines buffered for a chat as one message, grouped by project
+    """
+    projects = {}
+    for project, event, line in buffer["items"]:
+        projects.setdefault(project, []).append(line)
+    for project in buffer["overflow"]:
+        projects.setdefault(project, [])
+    message = f"{mode.capitalize()} digest"
+    for project, lines in projects.items():
+        message += f"\n\nProject {project}"
+        for line in lines:
+            message += f"\n- {line}"
+        for event, count in buffer["overflow"].get(project, {}).items():
+            message += f"\n- and {count} more {event} events"
+    run_operations(
+        bot, {chat_id: [operation("send_message", chat_id, message=message)]}
+    )
+
+
+def update_status(
+    context: Context, ctx: dict, object_id: int, status: str
+) -> Tuple[Tracked, bool]:
+    """
+    Store the new status of a tracked object, return the record and if it changed.
+    Every event bumps the revision, which outdates the retries of the previous ones
+    """
+    with context.lock:
+        context.save_table_later()
+        if object_id not in ctx:
+            ctx[object_id] = Tracked(status, revision=1)
+            return ctx[object_id], True
+        record = ctx[object_id]
+        record.revision += 1
+        if record.status == status:
+            return record, False
+        record.status = status
+        return record, True
+
+
+def content_hash(message: str, markup: InlineKeyboardMarkup) -> str:
+    """
+    Return a compact hash of a rendered message, None for the text when only
+    the markup is edited
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update((message or "").encode("utf-8"))
+    digest.update(b"\0")
+    if markup is not None:
+        digest.update(json.dumps(markup.to_dict(), sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_unchanged(bot: BotPool, record: Tracked, chat_id: int, rendered: str) -> bool:
+    """
+    Test if a tracked message already displays the rendered content, in which
+    case Telegram would refuse the edit
+    """
+    if record.hash(chat_id) != rendered:
+        return False
+    bot.context.metrics.incr("edits_suppressed")
+    return True
+
+
+def notify_tracked(
+    bot: BotPool,
+    chats: List[dict],
+    record: Tracked,
+    status_changed: bool,
+    render: Callable[[int], str],
+    markup: InlineKeyboardMarkup,
+    name: str,
+    track: dict,
+) -> None:
+    """
+    Send the message of a tracked object to the chats that don't display it yet
+    and update the status button of the others, all chats concurrently
+    """
+    messages = {}
+    operations = {}
+    rendered = content_hash(None, markup)
+    for chat in chats:
+        chat_id = chat["id"]
+        message_id = record.message_id(chat_id)
+        if message_id is None:
+            if chat["verbosity"] not in messages:
+                messages[chat["verbosity"]] = render(chat["verbosity"])
+            operations[chat_id] = [
+                operation(
+                    "send_message",
+                    chat_id,
+                    markup,
+                    message=messages[chat["verbosity"]],
+                    track=track,
+                    hash=rendered,
+                    base=record.revision,
+                )
+            ]
+        elif is_unchanged(bot, record, chat_id, rendered) or (
+            record.hash(chat_id) is None and not status_changed
+        ):
+            logging.info(f"WebHook received for {name} with unchanged status")
+        else:
+            operations[chat_id] = [
+                operation(
+                    "edit_message_reply_markup",
+                    chat_id,
+                    markup,
+                    message_id=message_id,
+                    bot_id=record.bot_id(chat_id),
+                    track=track,
+                    hash=rendered,
+                    base=record.revision,
+                )
+            ]
+    run_operations(bot, operations)
+
+
+def push_handler(
+    data: dict, bot: BotPool, chats: List[int], project_token: str
+) -> None:
+    """
+    Defines the handler for when a commit event is received
+    """
+    for commit in data["commits"]:
+
+        def render(verbosity: int) -> str:
             message = f'New commit on project {data["project"]["name"]}'
             message += f'\nAuthor : {commit["author"]["name"]}'
-            if chat["verbosity"] != VVVV:
+            if verbosity != VVVV:
                 message += "\nMessage: " + emojize(
                     commit["message"].partition("\n")[0], language="alias"
                 )
             else:
                 message += f'\nMessage: {emojize(commit["message"], language="alias")}'
-            if chat["verbosity"] >= VV:
+            if verbosity >= VV:
                 message += f'\nUrl : {commit["url"]}'
+            return message
 
-            bot.send_message(chat_id=chat["id"], message=message)
+        send_or_digest(
+            bot,
+            chats,
+            "push",
+            data["project"]["name"],
+            render,
+            f'{commit["author"]["name"]} : '
+            + emojize(commit["message"].partition("\n")[0], language="alias"),
+        )
 
 
-def tag_handler(data: dict, bot: Bot, chats: List[int], project_token: str) -> None:
+def tag_handler(data: dict, bot: BotPool, chats: List[int], project_token: str) -> None:
     """
     Defines the handler for when a tag event is received
     """
-    for chat in chats:
+
+    def render(verbosity: int) -> str:
         message = f'New tag event on project {data["project"]["name"]}'
-        if chat["verbosity"] >= VV:
+        if verbosity >= VV:
             message += f'\nTag :{data["ref"].lstrip("refs/tags/")}'
             message += (
                 f'\nURL : {data["project"]["web_url"]}/-/{data["ref"].lstrip("refs/")}'
             )
-        bot.send_message(chat_id=chat["id"], message=message)
+        return message
+
+    send_or_digest(
+        bot,
+        chats,
+        "tag",
+        data["project"]["name"],
+        render,
+        f'Tag {data["ref"][len("refs/tags/") :]}',
+    )
 
 
-def release_handler(data: dict, bot: Bot, chats: List[int], project_token: str) -> None:
+def release_handler(
+    data: dict, bot: BotPool, chats: List[int], project_token: str
+) -> None:
     """
     Defines the handler for when a release event is received
     """
-    for chat in chats:
+
+    def render(verbosity: int) -> str:
         message = f'New release event on project {data["project"]["name"]}'
-        if chat["verbosity"] >= VV:
+        if verbosity >= VV:
             message += f'\nName : {data["name"]}'
             message += f'\nTag : {data["tag"]}'
             message += (
                 f'\nDescription : {emojize(data["description"], language="alias")}'
             )
             message += f'\nURL : {data["url"]}'
-        bot.send_message(chat_id=chat["id"], message=message)
+        return message
+
+    send_or_digest(
+        bot,
+        chats,
+        "release",
+        data["project"]["name"],
+        render,
+        f'Release {data["name"]} ({data["tag"]})',
+    )
 
 
-def issue_handler(data: dict, bot: Bot, chats: List[int], project_token: str) -> None:
+def issue_handler(
+    data: dict, bot: BotPool, chats: List[int], project_token: str
+) -> None:
     """
-    Defines the handler for when an issue event is received
+    Defines the handler for when an issue event is received.
+    Each issue has a card per chat, edited on every event
     """
-    for chat in chats:
-        oa = data["object_attributes"]
+    ctx = bot.context.table[project_token]["issues"]
+    oa = data["object_attributes"]
+    status = oa["state"]
+    issue_id = oa["iid"]
+    new = issue_id not in ctx
+    record, status_changed = update_status(bot.context, ctx, issue_id, status)
+    with bot.context.lock:
+        ctx[issue_id] = ctx.pop(issue_id)
+        while len(ctx) > bot.context.config.get("issue-cards", 1000):
+            del ctx[next(iter(ctx))]
+    reply_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text=STATUSES[status], url=oa["url"])]]
+    )
+
+    def render(verbosity: int) -> str:
         message = ""
         if oa["confidential"]:
             message += "[confidential] "
-        message += f'New issue event on project {data["project"]["name"]}'
-        message += f'\nTitle : {oa["title"]}'
-        if chat["verbosity"] >= VVVV and oa["description"]:
-            message += f'\nDescription : {emojize(oa["description"], language="alias")}'
-        message += f'\nState : {oa["state"]}'
-        message += f'\nURL : {oa["url"]}'
-        if chat["verbosity"] >= VVV:
+        message += f'<b>Project</b> {html.escape(data["project"]["name"])}\n'
+        message += f"<b>Issue ID</b> {issue_id}\n"
+        message += f'<b>Title</b> {html.escape(oa["title"])}\n'
+        if verbosity >= VVVV and oa["description"]:
+            description = emojize(oa["description"], language="alias")
+            if len(description) > MAX_CARD_DESCRIPTION:
+                description = description[:MAX_CARD_DESCRIPTION] + "…"
+            message += f"<b>Description</b> {html.escape(description)}\n"
+        message += f"<b>State</b> {status}\n"
+        if verbosity >= VVV:
             if "assignees" in data:
                 assignees = ", ".join([x["name"] for x in data["assignees"]])
-                message += f"\nAssignee(s) : {assignees}"
-            labels = ", ".join([x["title"] for x in data["labels"]])
+                message += f"<b>Assignee(s)</b> {html.escape(assignees)}\n"
+            labels = html.escape(", ".join([x["title"] for x in data["labels"]]))
             if labels:
-                message += f"\nLabels : {labels}"
+                message += f"<b>Labels</b> {labels}\n"
             due_date = oa["due_date"]
             if due_date:
-                message += f"\nDue date : {due_date}"
-        bot.send_message(chat_id=chat["id"], message=message)
+                message += f"<b>Due date</b> {due_date}\n"
+        return message
+
+    notify_card(
+        bot,
+        chats,
+        record,
+        render,
+        reply_markup,
+        {"token": project_token, "kind": "issues", "id": issue_id},
+        f"Issue {issue_id} is now {status}" if status_changed and not new else None,
+    )
 
 
-def note_handler(data: dict, bot: Bot, chats: List[int], project_token: str) -> None:
+def notify_card(
+    bot: BotPool,
+    chats: List[dict],
+    record: Tracked,
+    render: Callable[[int], str],
+    markup: InlineKeyboardMarkup,
+    track: dict,
+    transition: str = None,
+) -> None:
     """
-    Defines the handler for when a note event is received
+    Send the card of a tracked object to the chats that don't display it yet
+    and edit it in the others, all chats concurrently.
+    The transition is sent as a reply to the card in the chats asking for it
     """
+    messages = render_per_verbosity(chats, render)
+    operations = {}
+    hashes = {
+        verbosity: content_hash(message, markup)
+        for verbosity, message in messages.items()
+    }
     for chat in chats:
-        message = "New note on "
-        if "commit" in data:
-            message += "commit "
-            info = f'\nCommit : {data["commit"]["url"]}'
-        elif "merge_request" in data:
-            message += "merge request "
-            info = f'\nMerge request : {data["merge_request"]["title"]}'
-        elif "issue" in data:
-            message += "issue "
-            info = f'\nIssue : {data["issue"]["title"]}'
+        chat_id = chat["id"]
+        message = messages[chat["verbosity"]]
+        rendered = hashes[chat["verbosity"]]
+        message_id = record.message_id(chat_id)
+        if message_id is None:
+            operations[chat_id] = [
+                operation(
+                    "send_message",
+                    chat_id,
+                    markup,
+                    message=message,
+                    track=track,
+                    hash=rendered,
+                    base=record.revision,
+                )
+            ]
+            continue
+        bot_id = record.bot_id(chat_id)
+        operations[chat_id] = []
+        if not is_unchanged(bot, record, chat_id, rendered):
+            operations[chat_id].append(
+                operation(
+                    "edit_message_text",
+                    chat_id,
+                    markup,
+                    message_id=message_id,
+                    message=message,
+                    bot_id=bot_id,
+                    track=track,
+                    hash=rendered,
+                    base=record.revision,
+                )
+            )
+        if transition and chat.get("issue_replies"):
+            operations[chat_id].append(
+                operation(
+                    "send_message",
+                    chat_id,
+                    message=transition,
+                    reply_to=message_id,
+                    bot_id=bot_id,
+                )
+            )
+    run_operations(bot, operations)
+
+
+def noteable(data: dict) -> Tuple[str, str]:
+    """
+    Return the kind of object a note is attached to and its description
+    """
+    if "commit" in data:
+        return "commit", f'\nCommit : {data["commit"]["url"]}'
+    if "merge_request" in data:
+        return "merge request", f'\nMerge request : {data["merge_request"]["title"]}'
+    if "issue" in data:
+        return "issue", f'\nIssue : {data["issue"]["title"]}'
+    return "snippet", f'\nSnippet : {data["snippet"]["title"]}'
+
+
+def note_handler(
+    data: dict, bot: BotPool, chats: List[int], project_token: str
+) -> None:
+    """
+    Defines the handler for when a note event is received.
+    Notes are grouped by noteable when the coalescer is enabled
+    """
+    coalescer = bot.context.note_coalescer
+    if coalescer is None:
+        send_notes(bot, [data], chats)
+        return
+    oa = data["object_attributes"]
+    key = (
+        project_token,
+        oa.get("noteable_type"),
+        oa.get("noteable_id") or oa.get("commit_id"),
+    )
+    coalescer.add(key, (data, chats))
+
+
+def send_notes(bot: BotPool, notes: List[dict], chats: List[int]) -> None:
+    """
+    Send one message for notes on the same noteable
+    """
+    data = notes[-1]
+    kind, info = noteable(data)
+
+    def render(verbosity: int) -> str:
+        if len(notes) == 1:
+            message = f'New note on {kind} on project {data["project"]["name"]}'
         else:
-            message += "snippet "
-            info = f'\nSnippet : {data["snippet"]["title"]}'
-        message += f'on project {data["project"]["name"]}'
+            message = (
+                f"{len(notes)} new notes on {kind} on project"
+                f' {data["project"]["name"]}'
+            )
         message += info
-        message += (
-            f'\nNote : {emojize(data["object_attributes"]["note"], language="alias")}'
-        )
-        if chat["verbosity"] >= VV:
-            message += f'\nURL : {data["object_attributes"]["url"]}'
-        bot.send_message(chat_id=chat["id"], message=message)
+        for note in notes:
+            oa = note["object_attributes"]
+            if len(notes) == 1:
+                message += f'\nNote : {emojize(oa["note"], language="alias")}'
+            else:
+                author = note.get("user", {}).get("name", "")
+                message += f'\n\n{author} : {emojize(oa["note"], language="alias")}'
+            if verbosity >= VV:
+                message += f'\nURL : {oa["url"]}'
+        return message
+
+    send_to_chats(bot, chats, render)
+
+
+def flush_notes(bot: BotPool, key: tuple, items: List[tuple]) -> None:
+    """
+    Send the notes grouped by the coalescer, to the chats of the last one
+    """
+    send_notes(bot, [data for data, _ in items], items[-1][1])
 
 
 def merge_request_handler(
-    data: dict, bot: Bot, chats: List[int], project_token: str
+    data: dict, bot: BotPool, chats: List[int], project_token: str
 ) -> None:
     """
     Defines the handler for when a merge request event is received
@@ -149,15 +637,8 @@ def merge_request_handler(
     ctx = bot.context.table[project_token]["merge_requests"]
     oa = data["object_attributes"]
     status = oa["state"]
-    status_changed = True
     mr_id = oa["iid"]
-    if mr_id in ctx:
-        if "status" in ctx[mr_id] and ctx[mr_id]["status"] == status:
-            status_changed = False
-        if status_changed:
-            ctx[mr_id]["status"] = status
-    else:
-        ctx[mr_id] = {"status": status}
+    record, status_changed = update_status(bot.context, ctx, mr_id, status)
     message = f'<b>Project</b> {data["repository"]["name"]}\n'
     message += f"<b>Merge Request ID</b> {mr_id}\n"
     message += f'<b>Title</b> {oa["title"]}\n\n'
@@ -171,98 +652,96 @@ def merge_request_handler(
     reply_markup = InlineKeyboardMarkup(
         [[InlineKeyboardButton(text=STATUSES[status], url=url)]]
     )
-    for chat in chats:
-        if chat["verbosity"] >= VVV and labels:
-            message += f"<b>Labels</b> {labels}"
-        if "message_id" in ctx[mr_id]:
-            message_id = ctx[mr_id]["message_id"]
-            if status_changed:
-                bot.bot.edit_message_reply_markup(
-                    chat_id=chat["id"], message_id=message_id, reply_markup=reply_markup
-                )
-            else:
-                logging.info(f"WebHook received for Job {mr_id} with unchanged status")
-        else:
-            message_id = bot.send_message(
-                chat_id=chat["id"], message=message, markup=reply_markup
-            )
-            ctx[mr_id]["message_id"] = message_id
+
+    def render(verbosity: int) -> str:
+        if verbosity >= VVV and labels:
+            return message + f"<b>Labels</b> {labels}"
+        return message
+
+    notify_tracked(
+        bot,
+        chats,
+        record,
+        status_changed,
+        render,
+        reply_markup,
+        f"Merge Request {mr_id}",
+        {"token": project_token, "kind": "merge_requests", "id": mr_id},
+    )
 
 
 def job_event_handler(
-    data: dict, bot: Bot, chats: List[int], project_token: str
+    data: dict, bot: BotPool, chats: List[int], project_token: str
 ) -> None:
     """
     Defines the handler for when a job event is received
     """
     ctx = bot.context.table[project_token]["jobs"]
     status = data["build_status"]
-    status_changed = True
     job_id = data["build_id"]
-    if job_id in ctx:
-        if "status" in ctx[job_id] and ctx[job_id]["status"] == status:
-            status_changed = False
-        if status_changed:
-            ctx[job_id]["status"] = status
-    else:
-        ctx[job_id] = {"status": status}
+    record, status_changed = update_status(bot.context, ctx, job_id, status)
     message = f'<b>Project</b> {data["repository"]["name"]}\n'
     message += f"<b>Job ID</b> {job_id}\n\n"
     url = f'{data["repository"]["homepage"]}/-/jobs/{job_id}'
     reply_markup = InlineKeyboardMarkup(
         [[InlineKeyboardButton(text=STATUSES[status], url=url)]]
     )
-    for chat in chats:
-        if chat["verbosity"] >= VV:
-            message += f'<b>Job name</b> {data["build_name"]}\n'
-            message += f'<b>Job stage</b> {data["build_stage"]}'
+
+    def render(verbosity: int) -> str:
+        text = message
+        if verbosity >= VV:
+            text += f'<b>Job name</b> {data["build_name"]}\n'
+            text += f'<b>Job stage</b> {data["build_stage"]}'
         if status == "failed":
-            message += f'\n\n<b>Failure reason</b> {data["build_failure_reason"]}\n'
-        if "message_id" in ctx[job_id]:
-            message_id = ctx[job_id]["message_id"]
-            if status_changed:
-                bot.bot.edit_message_reply_markup(
-                    chat_id=chat["id"], message_id=message_id, reply_markup=reply_markup
-                )
-            else:
-                logging.info(f"WebHook received for Job {job_id} with unchanged status")
-        else:
-            message_id = bot.send_message(
-                chat_id=chat["id"], message=message, markup=reply_markup
-            )
-            ctx[job_id]["message_id"] = message_id
+            text += f'\n\n<b>Failure reason</b> {data["build_failure_reason"]}\n'
+        return text
+
+    notify_tracked(
+        bot,
+        chats,
+        record,
+        status_changed,
+        render,
+        reply_markup,
+        f"Job {job_id}",
+        {"token": project_token, "kind": "jobs", "id": job_id},
+    )
 
 
 def wiki_event_handler(
-    data: dict, bot: Bot, chats: List[int], project_token: str
+    data: dict, bot: BotPool, chats: List[int], project_token: str
 ) -> None:
     """
     Defines the handler for when a wiki page event is received
     """
-    for chat in chats:
+
+    def render(verbosity: int) -> str:
         message = f'New wiki page event on project {data["project"]["name"]}'
-        if chat["verbosity"] >= VV:
+        if verbosity >= VV:
             message += f'\nURL : {data["wiki"]["web_url"]}'
-        bot.send_message(chat_id=chat["id"], message=message)
+        return message
+
+    send_or_digest(
+        bot,
+        chats,
+        "wiki",
+        data["project"]["name"],
+        render,
+        f'Wiki page {data["object_attributes"]["title"]} '
+        f'{data["object_attributes"]["action"]}',
+    )
 
 
 def pipeline_handler(
-    data: dict, bot: Bot, chats: List[int], project_token: str
+    data: dict, bot: BotPool, chats: List[int], project_token: str
 ) -> None:
     """
     Defines the hander for when a pipeline event is received
     """
     ctx = bot.context.table[project_token]["pipelines"]
     status = data["object_attributes"]["status"]
-    status_changed = True
     pipeline_id = data["object_attributes"]["id"]
-    if pipeline_id in ctx:
-        if "status" in ctx[pipeline_id] and ctx[pipeline_id]["status"] == status:
-            status_changed = False
-        if status_changed:
-            ctx[pipeline_id]["status"] = data["object_attributes"]["status"]
-    else:
-        ctx[pipeline_id] = {"status": status}
+    record, status_changed = update_status(bot.context, ctx, pipeline_id, status)
     message = f'<b>Project</b> {data["project"]["name"]}\n'
     message += f"<b>Pipeline ID</b> {pipeline_id}\n\n"
     message += f'<b>Commit title</b> {data["commit"]["title"]}\n'
@@ -270,20 +749,13 @@ def pipeline_handler(
     reply_markup = InlineKeyboardMarkup(
         [[InlineKeyboardButton(text=STATUSES[status], url=url)]]
     )
-    for chat in chats:
-        if "message_id" in ctx[pipeline_id]:
-            message_id = ctx[pipeline_id]["message_id"]
-            if status_changed:
-                bot.bot.edit_message_reply_markup(
-                    chat_id=chat["id"], message_id=message_id, reply_markup=reply_markup
-                )
-            else:
-                logging.info(
-                    "WebHook received for Pipeline"
-                    f" {pipeline_id} with unchanged status"
-                )
-        else:
-            message_id = bot.send_message(
-                chat_id=chat["id"], message=message, markup=reply_markup
-            )
-            ctx[pipeline_id]["message_id"] = message_id
+    notify_tracked(
+        bot,
+        chats,
+        record,
+        status_changed,
+        lambda verbosity: message,
+        reply_markup,
+        f"Pipeline {pipeline_id}",
+        {"token": project_token, "kind": "pipelines", "id": pipeline_id},
+    )
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""
+gitlab-webhook-telegram
+
+Replay captured webhooks, see the capture option of config.json.
+
+    python replay.py configs/captures/*.jsonl.gz
+    python replay.py --url http://localhost:8080/ configs/captures/*.jsonl.gz
+
+Without --url, the app runs in this process on a copy of GWT_DIR and talks to a
+fake Telegram API. Tokens are found back from the hashes with the projects of
+GWT_DIR/config.json, the events of unknown projects are skipped.
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Tuple
+
+from classes.app import App
+from classes.capture import redact_token
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    A Telegram Bot API answering every call, counting them
+    """
+
+    def __init__(self, port: int, latency: float) -> None:
+        self.latency = latency
+        self.calls = 0
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", port), FakeTelegramHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """
+    The fake Telegram API request handler
+    """
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        data = self.rfile.read(int(self.headers["Content-Length"] or 0))
+        try:
+            body = json.loads(data) if data else {}
+        except ValueError:
+            body = {}
+        method = self.path.rsplit("/", 1)[-1]
+        token = self.path.split("/")[1][len("bot") :]
+        if method == "getUpdates":
+            time.sleep(1)
+            result = []
+        elif method == "getMe":
+            bot_id = token.split(":")[0]
+            result = {
+                "id": int(bot_id) if bot_id.isdigit() else 1,
+                "is_bot": True,
+                "first_name": "replay",
+                "username": f"replay_{bot_id}_bot",
+            }
+        else:
+            time.sleep(self.server.latency)
+            with self.server.lock:
+                self.server.calls += 1
+            result = True
+            if method in ("sendMessage", "editMessageText"):
+                result = {
+                    "message_id": next(self.server.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": int(body.get("chat_id", 0)), "type": "group"},
+                    "text": body.get("text", ""),
+                }
+        data = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+
+def read_captures(paths: List[str]) -> List[dict]:
+    """
+    Read the captured webhooks of all the files, oldest first
+    """
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rt") as capture_file:
+            entries.extend(json.loads(line) for line in capture_file if line.strip())
+    return sorted(entries, key=lambda entry: entry["time"])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(directory: str, telegram: FakeTelegram) -> Tuple[str, str]:
+    """
+    Run the app on a copy of directory, return the webhook and metrics URLs
+    """
+    copy = tempfile.mkdtemp(prefix="gwt-replay-") + "/"
+    for name in (
+        "config.json",
+        "verified_chats.json",
+        "chat_bots.json",
+        "chats_projects.json",
+    ):
+        if os.path.exists(directory + name):
+            shutil.copy(directory + name, copy + name)
+    with open(copy + "config.json") as config_file:
+        config = json.load(config_file)
+    config["port"] = free_port()
+    config["telegram-api-url"] = telegram.url
+    config.pop("capture", None)
+    with open(copy + "config.json", "w") as config_file:
+        json.dump(config, config_file)
+    threading.Thread(target=App(copy).run, daemon=True).start()
+    url = f"http://127.0.0.1:{config['port']}/"
+    while True:
+        try:
+            urllib.request.urlopen(url + "metrics").read()
+            return url, url + "metrics"
+        except OSError:
+            time.sleep(0.1)
+
+
+def replay(
+    entries: List[dict], url: str, tokens: dict, speed: float, new_uuids: bool
+) -> Iterator[Tuple[int, float]]:
+    """
+    Post the entries in order, yield the status code and latency of each one
+    """
+    start, first = time.monotonic(), entries[0]["time"] if entries else 0
+    for entry in entries:
+        headers = dict(entry["headers"])
+        headers["X-Gitlab-Token"] = tokens[headers.get("X-Gitlab-Token")]
+        if new_uuids:
+            headers["X-Gitlab-Event-UUID"] = str(uuid.uuid4())
+        if speed > 0:
+            delay = (entry["time"] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        request = urllib.request.Request(
+            url, entry["body"].encode("utf-8"), headers, method="POST"
+        )
+        sent = time.monotonic()
+        try:
+            with urllib.request.urlopen(request) as response:
+                code = response.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        yield code, time.monotonic() - sent
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * ratio))] if values else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[2])
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--url", help="webhook URL of a running instance")
+    parser.add_argument(
+        "--speed", type=float, default=0, help="1 keeps the captured pace, 0 no wait"
+    )
+    parser.add_argument(
+        "--new-uuids", action="store_true", help="avoid the duplicate detection"
+    )
+    parser.add_argument(
+        "--telegram-latency", type=float, default=0.05, help="fake API round trip"
+    )
+    args = parser.parse_args()
+
+    directory = os.getenv("GWT_DIR", "./configs/")
+    with open(directory + "config.json") as config_file:
+        config = json.load(config_file)
+    tokens = {
+        redact_token(project["token"]): project["token"]
+        for project in config["gitlab-projects"]
+    }
+    entries = read_captures(args.captures)
+    known = [e for e in entries if e["headers"].get("X-Gitlab-Token") in tokens]
+    print(f"{len(entries)} events captured, {len(entries) - len(known)} skipped")
+
+    telegram, metrics = None, None
+    url = args.url
+    if url is None:
+        telegram = FakeTelegram(0, args.telegram_latency)
+        url, metrics = start_app(directory, telegram)
+
+    start = time.monotonic()
+    results = list(replay(known, url, tokens, args.speed, args.new_uuids))
+    elapsed = time.monotonic() - start
+    latencies = sorted(latency for _, latency in results)
+    codes = {}
+    for code, _ in results:
+        codes[code] = codes.get(code, 0) + 1
+    print(f"{len(results)} events posted in {elapsed:.2f}s")
+    print(f"throughput: {len(results) / elapsed if elapsed else 0:.1f} events/s")
+    print(
+        "latency: "
+        + ", ".join(
+            f"{name} {percentile(latencies, ratio) * 1000:.1f}ms"
+            for name, ratio in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1))
+        )
+    )
+    print("status codes: " + ", ".join(f"{c}: {n}" for c, n in sorted(codes.items())))
+
+    if metrics is not None:
+        # Wait for the queue to be drained and the Telegram calls to stop
+        calls, changed = telegram.calls, time.monotonic()
+        while True:
+            time.sleep(0.1)
+            depth = json.load(urllib.request.urlopen(metrics)).get("queue_depth", 0)
+            if telegram.calls != calls:
+                calls, changed = telegram.calls, time.monotonic()
+            elif depth == 0 and time.monotonic() - changed > 1:
+                break
+        drained = changed - start
+        print(f"{telegram.calls} Telegram calls, queue drained in {drained:.2f}s")
+        print(f"end to end: {len(results) / drained if drained else 0:.1f} events/s")
+        print(json.dumps(json.load(urllib.request.urlopen(metrics)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Tests of classes.records and classes.table, which must read and write back
+the chats_projects.json files of previous versions
+"""
+
+import io
+import json
+
+from classes.records import Subscription, Tracked, encode
+from classes.table import KINDS, Table
+
+
+def round_trip(raw: dict) -> dict:
+    return json.loads(json.dumps(raw, default=encode))
+
+
+def test_legacy_message_id():
+    raw = {"status": "running", "message_id": 42}
+    record = Tracked.from_json(raw)
+    assert record.status == "running"
+    assert record.message_id(-100) == 42
+    assert record.bot_id(-100) is None
+    assert record.hash(-100) is None
+    assert record.to_json() == raw
+
+
+def test_legacy_message_id_with_chats():
+    record = Tracked.from_json(
+        {"status": "success", "message_id": 42, "messages": {"-100": [43]}}
+    )
+    assert record.message_id(-100) == 43
+    assert record.message_id(-200) == 42
+
+
+def test_messages_bots_and_hashes_per_chat():
+    raw = {
+        "status": "failed",
+        "messages": {"-100": [1], "-200": [2, 3]},
+        "bots": {"-100": 111, "-200": 222},
+        "hashes": {"-100": "00000000000000ab", "-200": "ffffffffffffffff"},
+    }
+    record = Tracked.from_json(raw)
+    assert record.message_id(-100) == 1
+    assert record.message_id(-200) == 3
+    assert record.bot_id(-200) == 222
+    assert record.hash(-100) == "00000000000000ab"
+    assert record.hash(-200) == "ffffffffffffffff"
+    assert round_trip(record) == raw
+
+
+def test_partial_chats():
+    raw = {"status": "pending", "bots": {"-100": 111}, "hashes": {"-200": "01"}}
+    record = Tracked.from_json(raw)
+    assert record.message_id(-100) is None
+    assert record.bot_id(-100) == 111
+    assert record.hash(-200) == "0000000000000001"
+    assert record.to_json() == {
+        "status": "pending",
+        "bots": {"-100": 111},
+        "hashes": {"-200": "0000000000000001"},
+    }
+
+
+def test_update_keeps_the_other_values():
+    record = Tracked("running")
+    record.update(-100, [1], 111, "00000000000000ab")
+    record.update(-100, hash="00000000000000cd")
+    record.update(-200, [2, 3])
+    assert record.message_id(-100) == 1
+    assert record.bot_id(-100) == 111
+    assert record.hash(-100) == "00000000000000cd"
+    assert record.message_id(-200) == 3
+    assert Tracked.from_json(round_trip(record)).to_json() == record.to_json()
+
+
+def test_revision_is_kept():
+    record = Tracked("running", revision=3)
+    assert round_trip(record) == {"status": "running", "revision": 3}
+    assert Tracked.from_json(round_trip(record)).revision == 3
+    assert "revision" not in Tracked("running").to_json()
+
+
+def test_subscription():
+    assert round_trip(Subscription.from_json({"verbosity": 2})) == {"verbosity": 2}
+    raw = {
+        "verbosity": 1,
+        "issue_replies": True,
+        "digests": {"push": "daily"},
+        "suspended": {"reason": "Forbidden", "since": 1},
+    }
+    subscription = Subscription.from_json(raw)
+    assert subscription.digests == {"push": "daily"}
+    assert round_trip(subscription) == raw
+
+
+def write(tmp_path, table: dict) -> str:
+    path = tmp_path / "chats_projects.json"
+    path.write_text(json.dumps(table))
+    return str(path)
+
+
+def test_table_round_trip(tmp_path):
+    raw = {
+        "token-a": {
+            "-100": {"verbosity": 3},
+            "jobs": {"12": {"status": "success", "message_id": 5}},
+            "pipelines": {},
+            "merge_requests": {
+                "3": {"status": "opened", "messages": {"-100": [6]}},
+            },
+            "issues": {},
+        },
+        "token-b": {"-200": {"verbosity": 0}},
+    }
+    table = Table(write(tmp_path, raw))
+    project = table["token-a"]
+    assert project[-100].verbosity == 3
+    assert project["jobs"][12].message_id(-100) == 5
+    assert project["merge_requests"][3].message_id(-100) == 6
+    assert table.chat_ids("token-b") == [-200]
+    outfile = io.StringIO()
+    table.dump(outfile)
+    written = json.loads(outfile.getvalue())
+    # Projects never accessed are written back as read
+    assert written["token-b"] == raw["token-b"]
+    assert written["token-a"] == raw["token-a"]
+
+
+def test_table_adds_missing_kinds(tmp_path):
+    table = Table(write(tmp_path, {"token": {"-100": {"verbosity": 1}}}))
+    project = table["token"]
+    for kind in KINDS:
+        assert project[kind] == {}
+    assert table.chat_ids("token") == [-100]
+
+
+def test_table_snapshot_is_not_changed_later(tmp_path):
+    raw = {"token": {"jobs": {"1": {"status": "running", "message_id": 5}}}}
+    table = Table(write(tmp_path, raw))
+    record = table["token"]["jobs"][1]
+    snapshot = table.snapshot()
+    record.status = "success"
+    record.update(-100, [6])
+    outfile = io.StringIO()
+    table.dump(outfile, snapshot)
+    assert (
+        json.loads(outfile.getvalue())["token"]["jobs"]["1"]
+        == raw["token"]["jobs"]["1"]
+    )
+
+
+def test_missing_file(tmp_path):
+    table = Table(str(tmp_path / "chats_projects.json"))
+    assert len(table) == 0
+    assert "token" not in table
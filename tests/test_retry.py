@@ -0,0 +1,153 @@
+"""
+Tests of classes.retry and of the outdated retries dropped by handlers
+"""
+
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import handlers
+from classes.retry import RetryScheduler, operation_key
+
+TRACK = {"token": "token", "kind": "merge_requests", "id": 7}
+
+
+def edit(message: str, chat_id: int = 5, track: dict = TRACK) -> dict:
+    return {
+        "method": "edit_message_text",
+        "chat_id": chat_id,
+        "message_id": 1,
+        "message": message,
+        "track": track,
+    }
+
+
+def scheduler(tmp_path, executed: list, **options) -> RetryScheduler:
+    return RetryScheduler(
+        lambda operation: executed.append(operation["message"]),
+        str(tmp_path / "dead_letters.jsonl"),
+        **options,
+    )
+
+
+def wait_for(condition, timeout: float = 2) -> None:
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+def test_operation_key():
+    assert operation_key(edit("a")) == (
+        "token",
+        "merge_requests",
+        "7",
+        5,
+        "edit_message_text",
+    )
+    assert operation_key({"method": "send_message", "chat_id": 5}) is None
+
+
+def test_retry_is_executed(tmp_path):
+    executed = []
+    retries = scheduler(tmp_path, executed)
+    retries.failed(edit("closed"), RetryAfter(0.05))
+    assert retries.pending() == 1
+    wait_for(lambda: executed == ["closed"])
+    assert retries.pending() == 0
+
+
+def test_newer_operation_replaces_pending(tmp_path):
+    executed = []
+    retries = scheduler(tmp_path, executed)
+    retries.failed(edit("closed"), RetryAfter(0.05))
+    retries.failed(edit("other chat", chat_id=6), RetryAfter(0.05))
+    retries.failed(edit("opened"), RetryAfter(0.05))
+    assert retries.pending() == 2
+    wait_for(lambda: len(executed) == 2)
+    assert sorted(executed) == ["opened", "other chat"]
+
+
+def test_replaced_operation_failing_again_is_dropped(tmp_path):
+    executed = []
+    retries = scheduler(tmp_path, executed)
+    old = edit("closed")
+    retries.failed(old, RetryAfter(0.05))
+    retries.failed(edit("opened"), RetryAfter(0.05))
+    # The old operation was being executed when the new one was scheduled
+    retries.failed(old, NetworkError("Bad Gateway"), attempts=2)
+    assert retries.pending() == 1
+    wait_for(lambda: executed == ["opened"])
+
+
+def test_permanent_error_goes_to_dead_letters(tmp_path):
+    retries = scheduler(tmp_path, [])
+    retries.failed(edit("closed"), BadRequest("Chat not found"))
+    retries.failed(edit("opened", chat_id=6), NetworkError("Bad Gateway"), 5)
+    assert retries.pending() == 0
+    entries = retries.dead_letters()
+    assert [entry["operation"]["message"] for entry in entries] == [
+        "closed",
+        "opened",
+    ]
+    assert entries[0]["error"] == "BadRequest: Chat not found"
+    assert entries[1]["attempts"] == 5
+
+
+def test_replay_keeps_the_last_operation_per_message(tmp_path):
+    executed = []
+    retries = scheduler(tmp_path, executed)
+    error = BadRequest("Chat not found")
+    retries.failed(edit("closed"), error)
+    retries.failed({"method": "send_message", "chat_id": 5, "message": "push"}, error)
+    retries.failed(edit("opened"), error)
+    assert retries.replay() == 3
+    wait_for(lambda: len(executed) == 2)
+    assert sorted(executed) == ["opened", "push"]
+    assert retries.dead_letters() == []
+
+
+def test_replay_skips_messages_with_a_pending_retry(tmp_path):
+    executed = []
+    retries = scheduler(tmp_path, executed)
+    retries.failed(edit("closed"), BadRequest("Chat not found"))
+    retries.failed(edit("opened"), RetryAfter(0.2))
+    retries.replay()
+    wait_for(lambda: executed == ["opened"])
+    time.sleep(0.05)
+    assert executed == ["opened"]
+
+
+class FakeContext:
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.table = {"token": {"merge_requests": {}}}
+
+    def save_table_later(self) -> None:
+        pass
+
+
+class FakePool:
+    def __init__(self) -> None:
+        self.context = FakeContext()
+
+
+def test_operation_outdated_by_a_later_event():
+    bot = FakePool()
+    project = bot.context.table["token"]["merge_requests"]
+    record, _ = handlers.update_status(bot.context, project, 7, "opened")
+    record.update(5, [1], 1, handlers.content_hash("Opened", None))
+    # The edit to closed fails, then the merge request is reopened: the card
+    # renders as before and no edit is made, the retry must not close it
+    record, _ = handlers.update_status(bot.context, project, 7, "closed")
+    closed = dict(edit("Closed"), base=record.revision)
+    assert not handlers.is_stale(bot, closed)
+    handlers.update_status(bot.context, project, 7, "opened")
+    assert handlers.is_stale(bot, closed)
+
+
+def test_untracked_operation_is_never_outdated():
+    bot = FakePool()
+    assert not handlers.is_stale(bot, {"method": "send_message", "chat_id": 5})
+    assert not handlers.is_stale(bot, dict(edit("Closed"), base=1))
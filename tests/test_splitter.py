@@ -0,0 +1,73 @@
+"""
+Tests of classes.splitter
+"""
+
+import random
+
+import pytest
+
+from classes.splitter import split_message, utf16_length, visible_text
+
+
+def check(message: str, limit: int) -> list:
+    """
+    Split a message and test that no text is lost and every part is valid
+    """
+    parts = split_message(message, limit)
+    for part in parts:
+        assert visible_text(part).strip(), f"empty part in {parts!r}"
+        assert utf16_length(visible_text(part)) <= limit
+    text = "".join(visible_text(part) for part in parts)
+    assert "".join(text.split()) == "".join(visible_text(message).split())
+    return parts
+
+
+def test_short_message_is_kept():
+    assert split_message("<b>short</b>") == ["<b>short</b>"]
+
+
+@pytest.mark.parametrize(
+    "message, limit",
+    [
+        ("<b>" + "a" * 4096 + "\n</b>", 4096),
+        ("\n\naa&amp;a", 5),
+        ("<i>aaaaa\n</i>", 5),
+        ("aaaaa\n\n\n   \n", 5),
+    ],
+)
+def test_no_part_without_text(message, limit):
+    check(message, limit)
+
+
+def test_cut_on_line_break():
+    assert split_message("aaa\nbbb", 5) == ["aaa", "bbb"]
+
+
+def test_tags_are_closed_and_reopened():
+    assert split_message("<b>aaa\nbbb</b>", 5) == ["<b>aaa</b>", "<b>bbb</b>"]
+
+
+def test_surrogate_pairs_are_not_cut():
+    parts = check("😀" * 5, 4)
+    assert parts == ["😀😀", "😀😀", "😀"]
+
+
+def test_long_line_is_cut_in_full_parts():
+    parts = check("<b>" + "ab😀" * 5000 + "</b>", 4096)
+    assert all(part.startswith("<b>") and part.endswith("</b>") for part in parts)
+    assert all(utf16_length(visible_text(part)) > 4000 for part in parts[:-1])
+    assert "".join(visible_text(part) for part in parts) == "ab😀" * 5000
+
+
+def test_entities_are_not_cut():
+    parts = check("aaaa&amp;&lt;", 5)
+    assert all(part.count("&") == part.count(";") for part in parts)
+
+
+def test_fuzz():
+    rng = random.Random(0)
+    alphabet = ["a", "b", " ", "\n", "😀", "é", "&amp;", "&lt;", "<b>", "</b>", "<i>"]
+    for _ in range(2000):
+        message = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 60)))
+        if visible_text(message).strip():
+            check(message, rng.randint(2, 12))